@@ -1,9 +1,13 @@
+import asyncio
+
 from dataclasses import asdict
+from typing import AsyncIterator
 from uuid import uuid4
 
 from arq import create_pool
 from arq.connections import RedisSettings
 from arq.typing import WorkerSettingsBase
+from arq.worker import Retry, func
 from langcodes import Language
 from quart import Quart, Response, abort, json, request, make_response
 from quart_cors import cors
@@ -11,6 +15,7 @@ from werkzeug.datastructures import Headers
 from werkzeug.exceptions import HTTPException
 from youtube_transcript_api import NoTranscriptFound, TranscriptsDisabled
 
+from checkpoint import delete_summary_checkpoint
 from constants import APPLICATION_JSON
 from database.chapter import \
     create_chapter_table, \
@@ -21,7 +26,6 @@ from database.data import \
     ChapterSlicer, \
     Feedback, \
     State, \
-    TimedText, \
     User
 from database.feedback import \
     create_feedback_table, \
@@ -30,21 +34,63 @@ from database.feedback import \
     delete_feedback
 from database.translation import create_translation_table, delete_translation
 from database.user import create_user_table, find_user, insert_or_update_user
+from lease import acquire_lease, hand_over_lease, keep_lease, release_lease
 from logger import logger
+from openai import \
+    open_chat_client, \
+    close_chat_client, \
+    set_chat_deadline, \
+    set_chat_schedule, \
+    reset_chat_deadline, \
+    reset_chat_schedule
 from rds import rds
-from sse import sse_subscribe
+from sse import \
+    SseEvent, \
+    SseMessage, \
+    close_sse_hub, \
+    open_sse_hub, \
+    sse_publish, \
+    sse_subscribe
+from single_flight import close_single_flight_hub, open_single_flight_hub
 from summary import \
+    SUMMARIZE_JOB_TIMEOUT, \
+    SUMMARIZE_LONG_JOB_TIMEOUT, \
+    SUMMARIZING_LEASE_EX, \
+    SUMMARIZING_LEASE_INTERVAL, \
     SUMMARIZING_RDS_KEY_EX, \
-    NO_TRANSCRIPT_RDS_KEY_EX, \
+    SUMMARIZING_RESERVED, \
+    SUMMARY_CHANNEL_PATTERN, \
+    ChapterSummaryStrategy, \
+    SummarizeQueue, \
+    SummaryConcurrency, \
     build_summary_channel, \
     build_summary_response, \
+    build_summarize_job_id, \
     build_summarizing_rds_key, \
-    build_no_transcript_rds_key, \
+    choose_summarize_queue, \
     do_if_found_chapters_in_database, \
+    do_if_no_transcript, \
+    estimate_summarize_tokens, \
+    estimate_transcript_tokens, \
+    fetch_timed_texts_and_lang, \
+    get_summarize_job_deadline, \
+    has_bad_feedback, \
     need_to_resummarize, \
-    parse_timed_texts_and_lang, \
     summarize as summarizing
-from translation import translate as translating
+from transcript_cache import \
+    delete_no_transcript_cache, \
+    get_transcript_ref, \
+    has_no_transcript_cache
+from translation import \
+    has_translations_in_flight, \
+    precompute_translations, \
+    translate as translating, \
+    translate_all as translating_all
+
+# Precompute translations in the idle time of the summarize workers.
+PRECOMPUTE_TRANSLATION_QUEUE = 'arq:queue:precompute_translation'
+PRECOMPUTE_TRANSLATION_DEFER = 60  # in seconds.
+PRECOMPUTE_TRANSLATION_MAX_TRIES = 60  # about 1 hour if keep yielding.
 
 app = Quart(__name__)
 app = cors(app, allow_origin='*')
@@ -60,6 +106,17 @@ create_user_table()
 async def before_serving():
     logger.info(f'create arq in app before serving')
     app.arq = await create_pool(RedisSettings())
+    await open_chat_client()
+    await open_sse_hub(SUMMARY_CHANNEL_PATTERN)
+    await open_single_flight_hub()
+
+
+@app.after_serving
+async def after_serving():
+    logger.info(f'close chat client in app after serving')
+    await close_chat_client()
+    await close_sse_hub()
+    await close_single_flight_hub()
 
 
 # https://flask.palletsprojects.com/en/2.2.x/errorhandling/#generic-exception-handler
@@ -143,66 +200,57 @@ async def summarize(vid: str):
     chapters = _parse_chapters_from_body(body)
     no_transcript = bool(body.get('no_transcript', False))
 
-    no_transcript_rds_key = build_no_transcript_rds_key(vid)
     summarizing_rds_key = build_summarizing_rds_key(vid)
     channel = build_summary_channel(vid)
+    cache = True
 
     found = find_chapters_by_vid(vid)
     if found:
         if (chapters and found[0].slicer != ChapterSlicer.YOUTUBE) or \
                 need_to_resummarize(vid, found):
             logger.info(f'summarize, need to resummarize, vid={vid}')
+            cache = not has_bad_feedback(vid)
             delete_chapters_by_vid(vid)
             delete_feedback(vid)
             delete_translation(vid)
-            rds.delete(no_transcript_rds_key)
-            rds.delete(summarizing_rds_key)
+            delete_summary_checkpoint(vid)
+            delete_no_transcript_cache(vid)
         else:
             logger.info(f'summarize, found chapters in database, vid={vid}')
             await do_if_found_chapters_in_database(vid, found)
             return build_summary_response(State.DONE, found)
 
-    if rds.exists(no_transcript_rds_key) or no_transcript:
+    if has_no_transcript_cache(vid) or no_transcript:
         logger.info(f'summarize, but no transcript for now, vid={vid}')
         return build_summary_response(State.NOTHING)
 
-    if rds.exists(summarizing_rds_key):
+    # Reserve the summarizing flag atomically, the job will take it over as a lease;
+    # the transcript will be fetched in the job, see do_summarize_job.
+    if not rds.set(summarizing_rds_key, SUMMARIZING_RESERVED, nx=True, ex=SUMMARIZING_RDS_KEY_EX):  # nopep8.
         logger.info(f'summarize, but repeated, vid={vid}')
         return await _build_sse_response(channel)
 
-    # Set the summary proccess beginning flag here,
-    # because of we need to get the transcript first,
-    # and try to avoid youtube rate limits.
-    rds.set(summarizing_rds_key, 1, ex=SUMMARIZING_RDS_KEY_EX)
+    # Short jobs shouldn't wait behind long ones, estimate without fetching the transcript.
+    tokens = estimate_summarize_tokens(vid, chapters)
+    queue = choose_summarize_queue(tokens)
+    logger.info(f'summarize, enqueue, vid={vid}, tokens={tokens}, queue={queue}')
 
-    try:
-        # FIXME (Matthew Lee) youtube rate limits?
-        timed_texts, lang = parse_timed_texts_and_lang(vid)
-        if not timed_texts:
-            logger.warning(f'summarize, but no transcript found, vid={vid}')
-            rds.set(no_transcript_rds_key, 1, ex=NO_TRANSCRIPT_RDS_KEY_EX)
-            rds.delete(summarizing_rds_key)
-            return build_summary_response(State.NOTHING)
-    except (NoTranscriptFound, TranscriptsDisabled):
-        logger.warning(f'summarize, but no transcript found, vid={vid}')
-        rds.set(no_transcript_rds_key, 1, ex=NO_TRANSCRIPT_RDS_KEY_EX)
-        rds.delete(summarizing_rds_key)
-        return build_summary_response(State.NOTHING)
-    except Exception:
-        logger.exception(f'summarize failed, vid={vid}')
-        rds.delete(no_transcript_rds_key)
-        rds.delete(summarizing_rds_key)
-        raise  # to errorhandler.
-
-    await app.arq.enqueue_job(
+    # arq never enqueues the job with the same id twice,
+    # until the previous one finished (its result is not kept).
+    job = await app.arq.enqueue_job(
         do_summarize_job.__name__,
         vid,
         uid,
         chapters,
-        timed_texts,
-        lang,
+        get_transcript_ref(vid),  # fetch in the job if not cached.
         openai_api_key,
+        cache=cache,
+        queue=queue.value,
+        _job_id=build_summarize_job_id(vid, queue),
+        _queue_name=queue.value,
     )
+    if not job:
+        logger.info(f'summarize, but job exists, vid={vid}')
 
     return await _build_sse_response(channel)
 
@@ -228,27 +276,46 @@ async def translate(vid: str):
     if not cid:
         abort(400, f'"cid" must not empty')
 
-    lang = body.get('lang', '')
-    if not isinstance(lang, str):
-        abort(400, f'"lang" must be string')
-    lang = lang.strip()
-    if not lang:
-        abort(400, f'"lang" must not empty')
-    lang = Language.get(lang)  # LanguageTagError.
-    if not lang.is_valid():
-        abort(400, f'"lang" invalid')
-    lang = lang.language  # to str.
-
     trans = await translating(
         vid=vid,
         cid=cid,
-        lang=lang,
+        lang=_parse_lang_from_body(body),
         openai_api_key=openai_api_key,
     )
 
     return asdict(trans) if trans else {}
 
 
+# {
+#   'lang': str, required.
+# }
+#
+# Translate all chapters of the video, every translation is sent as an SSE
+# "translation" event as soon as it's done, then a "close" event.
+@app.post('/api/translate/<string:vid>/all')
+async def translate_all(vid: str):
+    _ = _parse_uid_from_headers(request.headers)
+    openai_api_key = _parse_openai_api_key_from_headers(request.headers)
+
+    try:
+        body: dict = await request.get_json() or {}
+    except Exception as e:
+        abort(400, f'translate all failed, e={e}')
+
+    translations = await translating_all(
+        vid=vid,
+        lang=_parse_lang_from_body(body),
+        openai_api_key=openai_api_key,
+    )
+
+    async def _stream():
+        async for trans in translations:
+            yield str(SseMessage(event=SseEvent.TRANSLATION.value, data=asdict(trans)))  # nopep8.
+        yield str(SseMessage(event=SseEvent.CLOSE.value))
+
+    return await _build_stream_response(_stream())
+
+
 def _parse_uid_from_headers(headers: Headers, check: bool = True) -> str:
     uid = headers.get(key='uid', default='', type=str)
     if not isinstance(uid, str):
@@ -276,6 +343,19 @@ def _parse_openai_api_key_from_headers(headers: Headers) -> str:
     return openai_api_key.strip()
 
 
+def _parse_lang_from_body(body: dict) -> str:
+    lang = body.get('lang', '')
+    if not isinstance(lang, str):
+        abort(400, f'"lang" must be string')
+    lang = lang.strip()
+    if not lang:
+        abort(400, f'"lang" must not empty')
+    lang = Language.get(lang)  # LanguageTagError.
+    if not lang.is_valid():
+        abort(400, f'"lang" invalid')
+    return lang.language  # to str.
+
+
 def _parse_chapters_from_body(body: dict) -> list[dict]:
     chapters = body.get('chapters', [])
     if not isinstance(chapters, list):
@@ -289,11 +369,13 @@ def _parse_chapters_from_body(body: dict) -> list[dict]:
 # ctx is arq first param, keep it.
 async def do_on_arq_worker_startup(ctx: dict):
     logger.info(f'arq worker startup')
+    await open_chat_client()
 
 
 # ctx is arq first param, keep it.
 async def do_on_arq_worker_shutdown(ctx: dict):
     logger.info(f'arq worker shutdown')
+    await close_chat_client()
 
 
 # ctx is arq first param, keep it.
@@ -302,24 +384,132 @@ async def do_summarize_job(
     vid: str,
     trigger: str,
     chapters: list[dict],
-    timed_texts: list[TimedText],
-    lang: str,
+    transcript_ref: str,
     openai_api_key: str = '',
+    cache: bool = True,
+    stream: bool = True,
+    chapter_strategy: str = ChapterSummaryStrategy.AUTO.value,
+    concurrency: str = SummaryConcurrency.SCHEDULED.value,
+    queue: str = SummarizeQueue.SHORT.value,
 ):
-    logger.info(f'do summarize job, vid={vid}')
-
-    # Set flag again, although we have done this before.
+    logger.info(f'do summarize job, '
+                f'vid={vid}, '
+                f'transcript_ref={transcript_ref}, '
+                f'queue={queue}, '
+                f'stream={stream}, '
+                f'chapter_strategy={chapter_strategy}, '
+                f'concurrency={concurrency}')
+
+    # Exactly one job of the same vid runs at the same time,
+    # even if arq retries it while the previous try is still running somewhere.
     summarizing_rds_key = build_summarizing_rds_key(vid)
-    rds.set(summarizing_rds_key, 1, ex=SUMMARIZING_RDS_KEY_EX)
+    token = str(uuid4())
+    if not await acquire_lease(
+        key=summarizing_rds_key,
+        token=token,
+        ex=SUMMARIZING_LEASE_EX,
+        placeholder=SUMMARIZING_RESERVED,
+    ):
+        logger.warning(f'do summarize job, but already running, vid={vid}')
+        return
+
+    heartbeat = asyncio.create_task(keep_lease(
+        key=summarizing_rds_key,
+        token=token,
+        ex=SUMMARIZING_LEASE_EX,
+        interval=SUMMARIZING_LEASE_INTERVAL,
+    ))
 
-    chapters, _ = await summarizing(
-        vid=vid,
-        trigger=trigger,
-        chapters=chapters,
-        timed_texts=timed_texts,
-        lang=lang,
-        openai_api_key=openai_api_key,
-    )
+    try:
+        await _do_summarize_job(
+            ctx=ctx,
+            token=token,
+            vid=vid,
+            trigger=trigger,
+            chapters=chapters,
+            transcript_ref=transcript_ref,
+            openai_api_key=openai_api_key,
+            cache=cache,
+            stream=stream,
+            chapter_strategy=chapter_strategy,
+            concurrency=concurrency,
+            queue=queue,
+        )
+    finally:
+        heartbeat.cancel()
+        await release_lease(summarizing_rds_key, token)
+
+
+async def _do_summarize_job(
+    ctx: dict,
+    token: str,
+    vid: str,
+    trigger: str,
+    chapters: list[dict],
+    transcript_ref: str,
+    openai_api_key: str = '',
+    cache: bool = True,
+    stream: bool = True,
+    chapter_strategy: str = ChapterSummaryStrategy.AUTO.value,
+    concurrency: str = SummaryConcurrency.SCHEDULED.value,
+    queue: str = SummarizeQueue.SHORT.value,
+):
+    try:
+        # FIXME (Matthew Lee) youtube rate limits?
+        timed_texts, lang = await fetch_timed_texts_and_lang(vid, transcript_ref)
+    except (NoTranscriptFound, TranscriptsDisabled):
+        timed_texts, lang = [], ''
+    except Exception:
+        logger.exception(f'summarize failed, vid={vid}')
+        delete_no_transcript_cache(vid)
+        await sse_publish(channel=build_summary_channel(vid), event=SseEvent.CLOSE)  # nopep8.
+        raise
+
+    if not timed_texts:
+        logger.warning(f'summarize, but no transcript found, vid={vid}')
+        await do_if_no_transcript(vid)
+        return
+
+    # The estimate at enqueue may be unknown, e.g. no transcript cached and no YouTube chapters,
+    # move the job to the long queue once the transcript turns out to be long.
+    if queue == SummarizeQueue.SHORT and \
+            choose_summarize_queue(estimate_transcript_tokens(timed_texts)) == SummarizeQueue.LONG:  # nopep8.
+        await _move_summarize_job_to_long_queue(
+            ctx=ctx,
+            token=token,
+            vid=vid,
+            trigger=trigger,
+            chapters=chapters,
+            openai_api_key=openai_api_key,
+            cache=cache,
+            stream=stream,
+            chapter_strategy=chapter_strategy,
+            concurrency=concurrency,
+        )
+        return
+
+    deadline = set_chat_deadline(get_summarize_job_deadline(queue))
+    schedule = set_chat_schedule(vid) \
+        if concurrency == SummaryConcurrency.SCHEDULED else None
+
+    try:
+        chapters, _ = await summarizing(
+            vid=vid,
+            trigger=trigger,
+            chapters=chapters,
+            timed_texts=timed_texts,
+            lang=lang,
+            openai_api_key=openai_api_key,
+            cache=cache,
+            stream=stream,
+            chapter_strategy=chapter_strategy,
+            concurrency=concurrency,
+            is_generated=timed_texts.is_generated,
+        )
+    finally:
+        if schedule:
+            reset_chat_schedule(schedule)
+        reset_chat_deadline(deadline)
 
     if chapters:
         logger.info(f'summarize, save chapters to database, vid={vid}')
@@ -327,15 +517,101 @@ async def do_summarize_job(
         delete_feedback(vid)
         delete_translation(vid)
         insert_chapters(chapters)
+        delete_summary_checkpoint(vid)
 
-    rds.delete(build_no_transcript_rds_key(vid))
-    rds.delete(summarizing_rds_key)
+        # Low priority, see do_precompute_translation_job.
+        try:
+            await ctx['redis'].enqueue_job(
+                do_precompute_translation_job.__name__,
+                vid,
+                _job_id=build_precompute_translation_job_id(vid),
+                _queue_name=PRECOMPUTE_TRANSLATION_QUEUE,
+                _defer_by=PRECOMPUTE_TRANSLATION_DEFER,
+            )
+        except Exception:
+            logger.exception(f'summarize, enqueue precompute translation failed, vid={vid}')  # nopep8.
+
+    delete_no_transcript_cache(vid)
+
+
+async def _move_summarize_job_to_long_queue(
+    ctx: dict,
+    token: str,
+    vid: str,
+    trigger: str,
+    chapters: list[dict],
+    openai_api_key: str = '',
+    cache: bool = True,
+    stream: bool = True,
+    chapter_strategy: str = ChapterSummaryStrategy.AUTO.value,
+    concurrency: str = SummaryConcurrency.SCHEDULED.value,
+):
+    # Hand the lease over as reserved, so that the next job can take it over,
+    # and the release of this job becomes a no-op.
+    summarizing_rds_key = build_summarizing_rds_key(vid)
+    if not await hand_over_lease(
+        key=summarizing_rds_key,
+        token=token,
+        ex=SUMMARIZING_RDS_KEY_EX,
+        placeholder=SUMMARIZING_RESERVED,
+    ):
+        logger.error(f'move summarize job to long queue, but lease lost, vid={vid}')  # nopep8.
+        return
+
+    queue = SummarizeQueue.LONG
+    logger.info(f'move summarize job to long queue, vid={vid}')
+
+    # The transcript has just been cached by the fetching, pass it by ref.
+    job = await ctx['redis'].enqueue_job(
+        do_summarize_job.__name__,
+        vid,
+        trigger,
+        chapters,
+        get_transcript_ref(vid),
+        openai_api_key,
+        cache=cache,
+        stream=stream,
+        chapter_strategy=chapter_strategy,
+        concurrency=concurrency,
+        queue=queue.value,
+        _job_id=build_summarize_job_id(vid, queue),
+        _queue_name=queue.value,
+    )
+    if not job:
+        logger.info(f'move summarize job to long queue, but job exists, vid={vid}')  # nopep8.
 
 
-# https://quart.palletsprojects.com/en/latest/how_to_guides/server_sent_events.html
 async def _build_sse_response(channel: str) -> Response:
+    return await _build_stream_response(sse_subscribe(channel))
+
+
+# ctx is arq first param, keep it.
+#
+# Translate the chapters to the most requested languages in the background,
+# and retry later as soon as any summarize job is waiting or running,
+# or any user is translating.
+async def do_precompute_translation_job(ctx: dict, vid: str):
+    logger.info(f'do precompute translation job, vid={vid}')
+
+    async def _should_yield() -> bool:
+        for queue in SummarizeQueue:
+            if await ctx['redis'].zcard(queue.value) > 0:
+                return True
+        # The users translating share the same chat rate limit.
+        return await has_translations_in_flight()
+
+    if not await precompute_translations(vid=vid, should_yield=_should_yield):
+        raise Retry(defer=PRECOMPUTE_TRANSLATION_DEFER)
+
+
+def build_precompute_translation_job_id(vid: str) -> str:
+    return f'precompute_translation_{vid}'
+
+
+# https://quart.palletsprojects.com/en/latest/how_to_guides/server_sent_events.html
+async def _build_stream_response(stream: AsyncIterator[str]) -> Response:
     res = await make_response(
-        sse_subscribe(channel),
+        stream,
         {
             'Content-Type': 'text/event-stream',
             'Transfer-Encoding': 'chunked',
@@ -349,7 +625,30 @@ async def _build_sse_response(channel: str) -> Response:
 
 
 # https://arq-docs.helpmanual.io/#simple-usage
+#
+# Every worker consumes one queue, weighted by max_jobs and the number of processes,
+# see ./pm2.json; short jobs never wait behind long ones, and long ones still make progress.
 class WorkerSettings(WorkerSettingsBase):
-    functions = [do_summarize_job]
+    # Don't keep the result, or the job of the same vid can't be enqueued again for a while.
+    functions = [func(do_summarize_job, keep_result=0)]
     on_startup = do_on_arq_worker_startup
     on_shutdown = do_on_arq_worker_shutdown
+    job_timeout = SUMMARIZE_JOB_TIMEOUT
+    queue_name = SummarizeQueue.SHORT.value
+    max_jobs = 10
+
+
+class LongWorkerSettings(WorkerSettings):
+    queue_name = SummarizeQueue.LONG.value
+    max_jobs = 4
+    job_timeout = SUMMARIZE_LONG_JOB_TIMEOUT
+
+
+class PrecomputeWorkerSettings(WorkerSettings):
+    functions = [func(
+        do_precompute_translation_job,
+        keep_result=0,
+        max_tries=PRECOMPUTE_TRANSLATION_MAX_TRIES,
+    )]
+    queue_name = PRECOMPUTE_TRANSLATION_QUEUE
+    max_jobs = 1
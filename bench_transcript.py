@@ -0,0 +1,108 @@
+# Report how many prompt tokens normalize_timed_texts() in ./transcript.py saves,
+# and how much memory Transcript saves compared with a list of TimedText.
+#
+# Usage:
+#
+#   pipenv run python bench_transcript.py <vid or transcript.json> ...
+#
+# The JSON file is the same as YouTubeTranscriptApi.get_transcript() returns,
+# i.e. [{"start": 0.0, "duration": 1.0, "text": "..."}], treated as auto captions.
+
+import asyncio
+import json
+import sys
+import tracemalloc
+
+from typing import Sequence
+
+from database.data import TimedText
+from summary import _plan, parse_timed_texts_and_lang
+from token_budget import build_lines_packer
+from transcript import Transcript, normalize_timed_texts
+
+
+# Returns (timed_texts, lang, is_generated).
+def _load(sample: str) -> tuple[Sequence[TimedText], str, bool]:
+    if not sample.endswith('.json'):
+        timed_texts, lang = parse_timed_texts_and_lang(sample)
+        return timed_texts, lang, timed_texts.is_generated
+
+    with open(sample, encoding='utf-8') as f:
+        array: list[dict] = json.load(f)
+
+    return [
+        TimedText(
+            start=d['start'],
+            duration=d['duration'],
+            text=d['text'],
+        )
+        for d in array
+    ], 'en', True
+
+
+async def _measure(sample: str, timed_texts: Transcript, lang: str) -> dict:
+    plan = await _plan(vid=sample, timed_texts=timed_texts, lang=lang)
+    packer = await build_lines_packer(timed_texts)
+    return {
+        'lines': len(timed_texts),
+        'strategy': plan.strategy,
+        'tokens_4k': plan.tokens_4k,
+        'line_tokens': packer.count(0, len(timed_texts)),
+    }
+
+
+# Returns (list bytes, transcript bytes) retained by the timed texts.
+def _measure_memory(timed_texts: list[TimedText]) -> tuple[int, int]:
+    tracemalloc.start()
+
+    # New objects for every line, as if they were just loaded.
+    timed_texts = [
+        TimedText(
+            start=t.start + 0.0,
+            duration=t.duration + 0.0,
+            lang=t.lang.encode().decode(),
+            text=t.text.encode().decode(),
+        )
+        for t in timed_texts
+    ]
+    list_bytes, _ = tracemalloc.get_traced_memory()
+
+    transcript = Transcript(timed_texts)
+    del timed_texts
+    transcript_bytes, _ = tracemalloc.get_traced_memory()
+
+    tracemalloc.stop()
+    del transcript
+    return list_bytes, transcript_bytes
+
+
+async def main(samples: list[str]):
+    total_raw = 0
+    total_normalized = 0
+
+    for sample in samples:
+        timed_texts, lang, is_generated = _load(sample)
+        list_bytes, transcript_bytes = _measure_memory(list(timed_texts))
+        raw = Transcript(timed_texts)
+        normalized = Transcript(normalize_timed_texts(raw, is_generated))
+
+        r = await _measure(sample, raw, lang)
+        n = await _measure(sample, normalized, lang)
+        total_raw += r['tokens_4k']
+        total_normalized += n['tokens_4k']
+
+        print(f'{sample}: '
+              f'lines {r["lines"]} -> {n["lines"]}, '
+              f'plan tokens {r["tokens_4k"]} -> {n["tokens_4k"]} '
+              f'({1 - n["tokens_4k"] / max(r["tokens_4k"], 1):.1%} less), '
+              f'line tokens {r["line_tokens"]} -> {n["line_tokens"]}, '
+              f'strategy {r["strategy"]} -> {n["strategy"]}, '
+              f'memory {list_bytes / 1024:.0f}KB as list -> {transcript_bytes / 1024:.0f}KB as transcript')  # nopep8.
+
+    if samples:
+        print(f'total: plan tokens {total_raw} -> {total_normalized} '
+              f'({1 - total_normalized / max(total_raw, 1):.1%} less)')
+
+
+if __name__ == '__main__':
+    asyncio.run(main(sys.argv[1:]))
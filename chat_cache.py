@@ -0,0 +1,162 @@
+import asyncio
+import hashlib
+import json
+import time
+
+from typing import Awaitable, Callable, Optional
+from uuid import uuid4
+
+from quart import abort
+
+from lease import acquire_lease, keep_lease, release_lease
+from logger import logger
+from rds import ards, rds
+
+CHAT_CACHE_EX = 7 * 24 * 60 * 60  # 7 days.
+CHAT_CACHE_MAX_ENTRIES = 20000
+CHAT_CACHE_MAX_BODY_SIZE = 64 * 1024  # in bytes.
+
+# The leader keeps renewing the lease while fetching, however long with retries,
+# and followers will take over soon after the leader crashed.
+_CHAT_CACHE_LEASE_EX = 60  # in seconds.
+_CHAT_CACHE_LEASE_INTERVAL = 20  # in seconds.
+_CHAT_CACHE_WAIT_INTERVAL = 0.2  # in seconds.
+
+_KEY_CHAT_CACHE_INDEX = 'chat_cache_index'  # sorted set, member is digest, score is timestamp.
+_KEY_CHAT_CACHE_HITS = 'chat_cache_hits'  # int.
+_KEY_CHAT_CACHE_MISSES = 'chat_cache_misses'  # int.
+
+# Stable digest of the request, the same request always has the same digest.
+def build_chat_cache_digest(url: str, model: str, top_p: float, messages: list[dict]) -> str:
+    request = json.dumps({
+        'url': url,
+        'model': model,
+        'top_p': top_p,
+        'messages': messages,
+    }, ensure_ascii=False, sort_keys=True, separators=(',', ':'))
+    return hashlib.sha256(request.encode()).hexdigest()
+
+
+def build_chat_cache_rds_key(digest: str) -> str:
+    return f'chat_cache_{digest}'
+
+
+def build_chat_cache_lock_rds_key(digest: str) -> str:
+    return f'chat_cache_lock_{digest}'
+
+
+def get_chat_cache_stats() -> dict:
+    hits = int(rds.get(_KEY_CHAT_CACHE_HITS) or 0)
+    misses = int(rds.get(_KEY_CHAT_CACHE_MISSES) or 0)
+    return {
+        'hits': hits,
+        'misses': misses,
+        'entries': rds.zcard(_KEY_CHAT_CACHE_INDEX),
+    }
+
+
+# Returns (body, hit).
+#
+# Only one caller (the leader) across all processes fetches the same digest at the same time,
+# the others (the followers) wait for the leader's result instead of fetching again.
+#
+# If not read, always fetch and overwrite the cached one, e.g. it was reported bad;
+# followers wait for the leader at most timeout seconds if any, e.g. the chat deadline.
+async def get_or_fetch_chat_cache(
+    digest: str,
+    fetch: Callable[[], Awaitable[dict]],
+    read: bool = True,
+    timeout: Optional[float] = None,
+) -> tuple[dict, bool]:
+    if not read:
+        body = await fetch()
+        await _set_chat_cache(digest, body)
+        return body, False
+
+    body = await _get_chat_cache(digest)
+    if body:
+        await ards.incr(_KEY_CHAT_CACHE_HITS)
+        return body, True
+
+    lock_key = build_chat_cache_lock_rds_key(digest)
+    token = str(uuid4())
+    deadline = time.monotonic() + timeout if timeout is not None else None
+
+    while True:
+        if await acquire_lease(lock_key, token, _CHAT_CACHE_LEASE_EX):
+            heartbeat = asyncio.create_task(keep_lease(
+                key=lock_key,
+                token=token,
+                ex=_CHAT_CACHE_LEASE_EX,
+                interval=_CHAT_CACHE_LEASE_INTERVAL,
+            ))
+
+            try:
+                # The previous leader may have finished just now.
+                body = await _get_chat_cache(digest)
+                if body:
+                    await ards.incr(_KEY_CHAT_CACHE_HITS)
+                    return body, True
+
+                await ards.incr(_KEY_CHAT_CACHE_MISSES)
+                body = await fetch()
+                await _set_chat_cache(digest, body)
+                return body, False
+            finally:
+                heartbeat.cancel()
+                await release_lease(lock_key, token)
+
+        if deadline is not None and time.monotonic() >= deadline:
+            abort(504, f'chat cache, wait for leader exceeded deadline, digest={digest}')  # nopep8.
+
+        await asyncio.sleep(_CHAT_CACHE_WAIT_INTERVAL)
+
+        body = await _get_chat_cache(digest)
+        if body:
+            logger.info(f'chat cache, coalesced, digest={digest}')
+            await ards.incr(_KEY_CHAT_CACHE_HITS)
+            return body, True
+
+        # Otherwise the leader failed, or is still fetching; try to become the leader.
+
+
+async def _get_chat_cache(digest: str) -> Optional[dict]:
+    value = await ards.get(build_chat_cache_rds_key(digest))
+    if not value:
+        return None
+
+    try:
+        return json.loads(value)
+    except Exception:
+        logger.exception(f'get chat cache failed, digest={digest}')
+        return None
+
+
+async def _set_chat_cache(digest: str, body: dict):
+    # Don't keep the truncated or filtered one, the next request deserves a fresh one.
+    choices = body.get('choices') or [{}]
+    finish_reason = choices[0].get('finish_reason')
+    if finish_reason != 'stop':
+        logger.info(f'set chat cache, but not stopped, digest={digest}, finish_reason={finish_reason}')  # nopep8.
+        return
+
+    value = json.dumps(body, ensure_ascii=False)
+    if len(value.encode()) > CHAT_CACHE_MAX_BODY_SIZE:
+        logger.info(f'set chat cache, but body too large, digest={digest}')
+        return
+
+    now = time.time()
+    await ards.set(build_chat_cache_rds_key(digest), value, ex=CHAT_CACHE_EX)
+    await ards.zadd(_KEY_CHAT_CACHE_INDEX, {digest: now})
+
+    # Entries expired by TTL are already gone, just forget them.
+    await ards.zremrangebyscore(_KEY_CHAT_CACHE_INDEX, '-inf', now - CHAT_CACHE_EX)
+
+    # Evict the oldest entries if there are too many.
+    overflow = await ards.zcard(_KEY_CHAT_CACHE_INDEX) - CHAT_CACHE_MAX_ENTRIES
+    if overflow > 0:
+        evicted = await ards.zpopmin(_KEY_CHAT_CACHE_INDEX, overflow)
+        keys = [build_chat_cache_rds_key(h.decode()) for h, _ in evicted]
+        if keys:
+            await ards.delete(*keys)
+        logger.info(f'set chat cache, evicted={len(keys)}')
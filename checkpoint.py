@@ -0,0 +1,104 @@
+import hashlib
+import json
+
+from dataclasses import asdict, dataclass, field
+from typing import Optional
+
+from database.data import Chapter
+from logger import logger
+from rds import ards, rds
+
+# Longer than the summarizing flag and the arq job retries,
+# so that a re-enqueued job can always resume.
+SUMMARY_CHECKPOINT_EX = 24 * 60 * 60  # 1 day.
+
+# Hash of every video, fields:
+#
+#   'digest': digest of the job inputs, the checkpoint is stale if changed.
+#   'chapters': JSON list of Chapter, the chapters to summarize.
+#   'chapter_{cid}': JSON of ChapterCheckpoint.
+_CHECKPOINT_FIELD_DIGEST = 'digest'
+_CHECKPOINT_FIELD_CHAPTERS = 'chapters'
+
+
+@dataclass
+class ChapterCheckpoint:
+    strategy: str = ''      # optional; ChapterSummaryStrategy.
+    summary: str = ''       # optional; the latest (intermediate) summary.
+    summary_start: int = 0  # optional; refine only, the next line to refine from.
+    refined: int = 0        # optional.
+    windows: dict[str, str] = field(default_factory=dict)  # optional; map-reduce only, "{start}:{end}" to summary.
+    done: bool = False      # optional.
+
+
+def build_summary_checkpoint_rds_key(vid: str) -> str:
+    return f'summary_checkpoint_{vid}'
+
+
+# The same inputs always have the same digest, whoever triggered the job.
+def build_summary_checkpoint_digest(chapters: list[dict], lang: str, timed_texts_len: int) -> str:
+    inputs = json.dumps({
+        'chapters': chapters,
+        'lang': lang,
+        'timed_texts_len': timed_texts_len,
+    }, ensure_ascii=False, sort_keys=True, separators=(',', ':'))
+    return hashlib.sha256(inputs.encode()).hexdigest()
+
+
+# Returns the chapters to summarize, or empty list if no checkpoint or stale.
+async def load_chapters_checkpoint(vid: str, digest: str) -> list[Chapter]:
+    key = build_summary_checkpoint_rds_key(vid)
+    found_digest, value = await ards.hmget(key, _CHECKPOINT_FIELD_DIGEST, _CHECKPOINT_FIELD_CHAPTERS)  # nopep8.
+    if not found_digest or not value:
+        return []
+
+    if found_digest.decode() != digest:
+        logger.info(f'load chapters checkpoint, but stale, vid={vid}')
+        await ards.delete(key)
+        return []
+
+    try:
+        return [Chapter(**c) for c in json.loads(value)]
+    except Exception:
+        logger.exception(f'load chapters checkpoint failed, vid={vid}')
+        return []
+
+
+# Overwrites all checkpoints of the video.
+async def save_chapters_checkpoint(vid: str, digest: str, chapters: list[Chapter]):
+    key = build_summary_checkpoint_rds_key(vid)
+    value = json.dumps([asdict(c) for c in chapters], ensure_ascii=False)
+
+    pipe = ards.pipeline()
+    pipe.delete(key)
+    pipe.hset(key, mapping={
+        _CHECKPOINT_FIELD_DIGEST: digest,
+        _CHECKPOINT_FIELD_CHAPTERS: value,
+    })
+    pipe.expire(key, SUMMARY_CHECKPOINT_EX)
+    await pipe.execute()
+
+
+async def load_chapter_checkpoint(vid: str, cid: str) -> Optional[ChapterCheckpoint]:
+    value = await ards.hget(build_summary_checkpoint_rds_key(vid), f'chapter_{cid}')  # nopep8.
+    if not value:
+        return None
+
+    try:
+        return ChapterCheckpoint(**json.loads(value))
+    except Exception:
+        logger.exception(f'load chapter checkpoint failed, vid={vid}, cid={cid}')  # nopep8.
+        return None
+
+
+async def save_chapter_checkpoint(vid: str, cid: str, checkpoint: ChapterCheckpoint):
+    key = build_summary_checkpoint_rds_key(vid)
+    value = json.dumps(asdict(checkpoint), ensure_ascii=False)
+
+    # Don't revive the checkpoint deleted or expired.
+    if await ards.exists(key):
+        await ards.hset(key, f'chapter_{cid}', value)
+
+
+def delete_summary_checkpoint(vid: str):
+    rds.delete(build_summary_checkpoint_rds_key(vid))
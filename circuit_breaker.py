@@ -0,0 +1,89 @@
+import time
+
+from collections import deque
+from typing import Optional
+
+from werkzeug.exceptions import HTTPException
+
+from logger import logger
+
+
+# Not a subclass of ServiceUnavailable, so that it won't be retried.
+class CircuitOpen(HTTPException):
+    code = 503
+    description = 'Upstream is unavailable for now, please try again later.'
+
+
+# https://martinfowler.com/bliki/CircuitBreaker.html
+#
+# Opens when the failure rate of the recent calls reaches the threshold,
+# then fails fast until `open_seconds` passed, and lets one call go through (half-open);
+# closes if the call succeeded, otherwise opens again.
+class CircuitBreaker:
+    def __init__(
+        self,
+        name: str,
+        window_size: int = 20,
+        min_calls: int = 10,
+        failure_rate: float = 0.5,  # [0, 1]
+        open_seconds: float = 30,
+    ):
+        self._name = name
+        self._outcomes: deque[bool] = deque(maxlen=window_size)
+        self._min_calls = min_calls
+        self._failure_rate = failure_rate
+        self._open_seconds = open_seconds
+        self._opened_at: Optional[float] = None
+        self._probing = False
+
+    @property
+    def is_open(self) -> bool:
+        return self._opened_at is not None
+
+    # Raises CircuitOpen if the call should not go through;
+    # returns True if the call is the probe (half-open), pass it to record().
+    def before_call(self) -> bool:
+        if self._opened_at is None:
+            return False
+
+        if self._probing or time.monotonic() - self._opened_at < self._open_seconds:  # nopep8.
+            raise CircuitOpen(f'circuit breaker "{self._name}" is open')
+
+        logger.info(f'circuit breaker half-open, name={self._name}')
+        self._probing = True
+        return True
+
+    # Healthy is None if the outcome is unknown, e.g. cancelled.
+    def record(self, healthy: Optional[bool], probe: bool = False):
+        if probe:
+            self._probing = False
+
+        if healthy is None:
+            return
+
+        # Only the probe decides while open,
+        # the other calls were already in flight before it opened.
+        if self._opened_at is not None and not probe:
+            return
+
+        if healthy:
+            if probe:
+                logger.info(f'circuit breaker closed, name={self._name}')
+                self._opened_at = None
+            self._outcomes.append(True)
+            return
+
+        self._outcomes.append(False)
+        if probe:
+            self._open()
+            return
+
+        total = len(self._outcomes)
+        failures = total - sum(self._outcomes)
+        if total >= self._min_calls and failures / total >= self._failure_rate:
+            self._open()
+
+    def _open(self):
+        logger.warning(f'circuit breaker opened, name={self._name}, outcomes={list(self._outcomes)}')  # nopep8.
+        self._opened_at = time.monotonic()
+        self._outcomes.clear()
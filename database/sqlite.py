@@ -27,6 +27,20 @@ def commit(sql: str):
         cursor.close()
 
 
+# Execute all in one transaction, either all or none.
+def commit_all(sqls: list[str]):
+    cursor = db_connection.cursor()
+    try:
+        for sql in sqls:
+            cursor.execute(sql)
+        db_connection.commit()
+    except Exception:
+        db_connection.rollback()
+        raise
+    finally:
+        cursor.close()
+
+
 def fetchall(sql: str) -> list[Any]:
     cursor = db_connection.cursor()
     try:
@@ -1,7 +1,7 @@
 from typing import Optional
 
 from database.data import Translation
-from database.sqlite import commit, fetchall, sqlescape
+from database.sqlite import commit, commit_all, fetchall, sqlescape
 
 _TABLE = 'translation'
 _COLUMN_VID = 'vid'
@@ -75,6 +75,28 @@ def find_translation(vid: str, cid: str, lang: str) -> Optional[Translation]:
     )
 
 
+def find_translations_by_vid(vid: str, lang: str) -> list[Translation]:
+    res = fetchall(f'''
+        SELECT
+              {_COLUMN_VID},
+              {_COLUMN_CID},
+              {_COLUMN_LANG},
+              {_COLUMN_CHAPTER},
+              {_COLUMN_SUMMARY}
+         FROM {_TABLE}
+        WHERE {_COLUMN_VID}  = '{sqlescape(vid)}'
+          AND {_COLUMN_LANG} = '{sqlescape(lang)}'
+        ''')
+
+    return list(map(lambda r: Translation(
+        vid=r[0],
+        cid=r[1],
+        lang=r[2],
+        chapter=r[3],
+        summary=r[4],
+    ), res))
+
+
 def insert_or_update_translation(translation: Translation):
     previous = find_translation(
         vid=translation.vid,
@@ -82,35 +104,21 @@ def insert_or_update_translation(translation: Translation):
         lang=translation.lang,
     )
     if not previous:
-        commit(f'''
-            INSERT INTO {_TABLE} (
-                {_COLUMN_VID},
-                {_COLUMN_CID},
-                {_COLUMN_LANG},
-                {_COLUMN_CHAPTER},
-                {_COLUMN_SUMMARY},
-                {_COLUMN_CREATE_TIMESTAMP},
-                {_COLUMN_UPDATE_TIMESTAMP}
-            ) VALUES (
-                '{sqlescape(translation.vid)}',
-                '{sqlescape(translation.cid)}',
-                '{sqlescape(translation.lang)}',
-                '{sqlescape(translation.chapter)}',
-                '{sqlescape(translation.summary)}',
-                STRFTIME('%s', 'NOW'),
-                STRFTIME('%s', 'NOW')
-            )
-            ''')
+        commit(_build_insert_sql(translation))
     else:
-        commit(f'''
-            UPDATE {_TABLE}
-               SET {_COLUMN_CHAPTER} = '{sqlescape(translation.chapter)}',
-                   {_COLUMN_SUMMARY} = '{sqlescape(translation.summary)}',
-                   {_COLUMN_UPDATE_TIMESTAMP} = STRFTIME('%s', 'NOW')
-             WHERE {_COLUMN_VID}  = '{sqlescape(translation.vid)}'
-               AND {_COLUMN_CID}  = '{sqlescape(translation.cid)}'
-               AND {_COLUMN_LANG} = '{sqlescape(translation.lang)}'
-            ''')
+        commit(_build_update_sql(translation))
+
+
+# All translations must be of the same vid and lang, in one transaction.
+def insert_or_update_translations(vid: str, lang: str, translations: list[Translation]):
+    if not translations:
+        return
+
+    previous = set(t.cid for t in find_translations_by_vid(vid=vid, lang=lang))
+    commit_all([
+        _build_update_sql(t) if t.cid in previous else _build_insert_sql(t)
+        for t in translations
+    ])
 
 
 def delete_translation(vid: str):
@@ -118,3 +126,37 @@ def delete_translation(vid: str):
         DELETE FROM {_TABLE}
         WHERE {_COLUMN_VID} = '{sqlescape(vid)}'
         ''')
+
+
+def _build_insert_sql(translation: Translation) -> str:
+    return f'''
+        INSERT INTO {_TABLE} (
+            {_COLUMN_VID},
+            {_COLUMN_CID},
+            {_COLUMN_LANG},
+            {_COLUMN_CHAPTER},
+            {_COLUMN_SUMMARY},
+            {_COLUMN_CREATE_TIMESTAMP},
+            {_COLUMN_UPDATE_TIMESTAMP}
+        ) VALUES (
+            '{sqlescape(translation.vid)}',
+            '{sqlescape(translation.cid)}',
+            '{sqlescape(translation.lang)}',
+            '{sqlescape(translation.chapter)}',
+            '{sqlescape(translation.summary)}',
+            STRFTIME('%s', 'NOW'),
+            STRFTIME('%s', 'NOW')
+        )
+        '''
+
+
+def _build_update_sql(translation: Translation) -> str:
+    return f'''
+        UPDATE {_TABLE}
+           SET {_COLUMN_CHAPTER} = '{sqlescape(translation.chapter)}',
+               {_COLUMN_SUMMARY} = '{sqlescape(translation.summary)}',
+               {_COLUMN_UPDATE_TIMESTAMP} = STRFTIME('%s', 'NOW')
+         WHERE {_COLUMN_VID}  = '{sqlescape(translation.vid)}'
+           AND {_COLUMN_CID}  = '{sqlescape(translation.cid)}'
+           AND {_COLUMN_LANG} = '{sqlescape(translation.lang)}'
+        '''
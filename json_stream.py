@@ -0,0 +1,75 @@
+import json
+
+from logger import logger
+
+
+# Parse the objects of a JSON array incrementally from a streamed completion,
+# every object is returned as soon as it closes, so that it can be published early;
+# the well-formed objects are kept even if the tail is truncated or malformed.
+#
+# The content is usually wrapped in markdown code block, or with redundant explanation,
+# so everything outside the array is skipped.
+class JsonArrayStream:
+    def __init__(self):
+        self.elements: list[dict] = []
+        self._reset()
+
+    # The content is the whole content so far, not the delta;
+    # returns the objects closed since the last feed.
+    def feed(self, content: str) -> list[dict]:
+        # The stream restarted, e.g. retried.
+        if len(content) < self._pos:
+            self.elements = []
+            self._reset()
+
+        closed: list[dict] = []
+        for i in range(self._pos, len(content)):
+            if self._done:
+                break
+
+            c = content[i]
+            if self._in_string:
+                if self._escaped:
+                    self._escaped = False
+                elif c == '\\':
+                    self._escaped = True
+                elif c == '"':
+                    self._in_string = False
+                continue
+
+            if c == '"':
+                self._in_string = self._depth > 0
+            elif c in '[{':
+                self._depth += 1
+                if c == '{' and self._depth == 2:
+                    self._element_start = i
+            elif c in ']}' and self._depth > 0:
+                self._depth -= 1
+                if c == '}' and self._depth == 1 and self._element_start >= 0:
+                    element = self._loads(content[self._element_start:i + 1])
+                    if element is not None:
+                        closed.append(element)
+                    self._element_start = -1
+                elif self._depth == 0:
+                    # Keep looking for the array if it's just a bracket in the explanation.
+                    self._done = bool(self.elements or closed)
+
+        self._pos = len(content)
+        self.elements.extend(closed)
+        return closed
+
+    def _loads(self, value: str):
+        try:
+            element = json.loads(value)
+        except json.JSONDecodeError:
+            logger.warning(f'json array stream, skip malformed element, value={value}')  # nopep8.
+            return None
+        return element if isinstance(element, dict) else None
+
+    def _reset(self):
+        self._pos = 0
+        self._depth = 0
+        self._in_string = False
+        self._escaped = False
+        self._element_start = -1
+        self._done = False
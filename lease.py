@@ -0,0 +1,87 @@
+import asyncio
+
+from logger import logger
+from rds import ards
+
+# KEYS: lease.
+# ARGV: token, ex in milliseconds, the placeholder value which can be taken over.
+# Returns 1 if acquired.
+_ACQUIRE_LUA = '''
+local value = redis.call('GET', KEYS[1])
+if value and value ~= ARGV[1] and value ~= ARGV[3] then
+    return 0
+end
+redis.call('SET', KEYS[1], ARGV[1], 'PX', ARGV[2])
+return 1
+'''
+
+# KEYS: lease.
+# ARGV: token, ex in milliseconds.
+# Returns 1 if renewed.
+_RENEW_LUA = '''
+if redis.call('GET', KEYS[1]) == ARGV[1] then
+    return redis.call('PEXPIRE', KEYS[1], ARGV[2])
+end
+return 0
+'''
+
+# KEYS: lease.
+# ARGV: token, ex in milliseconds, the placeholder value.
+# Returns 1 if handed over.
+_HAND_OVER_LUA = '''
+if redis.call('GET', KEYS[1]) == ARGV[1] then
+    redis.call('SET', KEYS[1], ARGV[3], 'PX', ARGV[2])
+    return 1
+end
+return 0
+'''
+
+# https://redis.io/docs/manual/patterns/distributed-locks/#correct-implementation-with-a-single-instance
+_RELEASE_LUA = '''
+if redis.call('GET', KEYS[1]) == ARGV[1] then
+    return redis.call('DEL', KEYS[1])
+end
+return 0
+'''
+
+_acquire_script = ards.register_script(_ACQUIRE_LUA)
+_renew_script = ards.register_script(_RENEW_LUA)
+_hand_over_script = ards.register_script(_HAND_OVER_LUA)
+_release_script = ards.register_script(_RELEASE_LUA)
+
+
+# A lease is a lock which expires unless its holder keeps renewing it,
+# so that it is never lost by a long holder, and never left behind by a crashed one.
+#
+# The placeholder is set by whoever reserves the lease for the holder, e.g. the app
+# reserves it with SET NX before enqueuing the job, and the job takes it over.
+async def acquire_lease(key: str, token: str, ex: float, placeholder: str = '') -> bool:
+    acquired = await _acquire_script(keys=[key], args=[token, int(ex * 1000), placeholder])  # nopep8.
+    return bool(acquired)
+
+
+async def renew_lease(key: str, token: str, ex: float) -> bool:
+    renewed = await _renew_script(keys=[key], args=[token, int(ex * 1000)])
+    return bool(renewed)
+
+
+# Replace the lease with the placeholder, so that the next holder can take it over.
+async def hand_over_lease(key: str, token: str, ex: float, placeholder: str) -> bool:
+    handed = await _hand_over_script(keys=[key], args=[token, int(ex * 1000), placeholder])  # nopep8.
+    return bool(handed)
+
+
+async def release_lease(key: str, token: str):
+    await _release_script(keys=[key], args=[token])
+
+
+# Renew the lease every interval until cancelled, or lost.
+async def keep_lease(key: str, token: str, ex: float, interval: float):
+    while True:
+        await asyncio.sleep(interval)
+        try:
+            if not await renew_lease(key, token, ex):
+                logger.error(f'keep lease, but lost, key={key}')
+                return
+        except Exception:
+            logger.exception(f'keep lease failed, key={key}')
@@ -0,0 +1,308 @@
+# A local stand-in of the OpenAI chat completions API for offline benchmarking,
+# which emulates latency, throughput, rate limits and failures,
+# and returns deterministic JSON for the prompts in ./prompt.py and ./translation.py.
+#
+# Usage:
+#
+#   MOCK_SEED=42 pipenv run hypercorn mock_openai:app --bind 127.0.0.1:8001
+#   redis-cli set openai_api_base http://127.0.0.1:8001/v1
+#   redis-cli set openai_api_key mock
+#
+# Execute `redis-cli del openai_api_base` to switch back to OpenAI.
+
+import asyncio
+import hashlib
+import json
+import os
+import random
+import re
+import time
+
+from uuid import uuid4
+
+from quart import Quart, Response, abort, request
+
+from constants import APPLICATION_JSON
+from openai import count_text_tokens
+
+_SEED = int(os.environ.get('MOCK_SEED', '0'))
+# Lognormal latency before the first token.
+_LATENCY_MEDIAN = float(os.environ.get('MOCK_LATENCY_MEDIAN', '0.5'))  # in seconds.
+_LATENCY_SIGMA = float(os.environ.get('MOCK_LATENCY_SIGMA', '0.5'))
+# Completion tokens per second of every request.
+_TOKENS_PER_SECOND = float(os.environ.get('MOCK_TOKENS_PER_SECOND', '50'))
+# Rate limits of the whole server.
+_REQUESTS_PER_MIN = int(os.environ.get('MOCK_REQUESTS_PER_MIN', '3500'))
+_TOKENS_PER_MIN = int(os.environ.get('MOCK_TOKENS_PER_MIN', '90000'))
+# Failures injection, [0, 1].
+_TOO_MANY_REQUESTS_RATE = float(os.environ.get('MOCK_TOO_MANY_REQUESTS_RATE', '0'))  # nopep8.
+_SERVER_ERROR_RATE = float(os.environ.get('MOCK_SERVER_ERROR_RATE', '0'))
+
+app = Quart(__name__)
+
+# Latency and failures are reproducible with the same seed and the same requests order.
+_random = random.Random(_SEED)
+_buckets = {
+    'requests': [float(_REQUESTS_PER_MIN), time.monotonic()],
+    'tokens': [float(_TOKENS_PER_MIN), time.monotonic()],
+}
+
+
+@app.post('/v1/chat/completions')
+async def chat_completions():
+    body: dict = await request.get_json() or {}
+    messages: list[dict] = body.get('messages', [])
+    model: str = body.get('model', '')
+    stream = bool(body.get('stream', False))
+    if not messages or not model:
+        abort(400, f'"messages" and "model" are required')
+
+    prompt_tokens = sum(count_text_tokens(m.get('content', '')) for m in messages)  # nopep8.
+
+    if _random.random() < _SERVER_ERROR_RATE:
+        return _build_error_response(_random.choice([500, 502, 503]), 'server_error')  # nopep8.
+
+    retry_after = _acquire(prompt_tokens)
+    if retry_after > 0 or _random.random() < _TOO_MANY_REQUESTS_RATE:
+        res = _build_error_response(429, 'rate_limit_exceeded')
+        res.headers['Retry-After'] = str(max(int(retry_after + 0.5), 1))
+        return res
+
+    content = _build_content(messages)
+    completion_tokens = count_text_tokens(content)
+    latency = _random.lognormvariate(0, _LATENCY_SIGMA) * _LATENCY_MEDIAN
+    duration = completion_tokens / _TOKENS_PER_SECOND
+
+    headers = _build_rate_limit_headers()
+    cid = f'chatcmpl-{uuid4().hex}'
+
+    if not stream:
+        await asyncio.sleep(latency + duration)
+        return Response(json.dumps({
+            'id': cid,
+            'object': 'chat.completion',
+            'created': int(time.time()),
+            'model': model,
+            'choices': [{
+                'index': 0,
+                'message': {
+                    'role': 'assistant',
+                    'content': content,
+                },
+                'finish_reason': 'stop',
+            }],
+            'usage': {
+                'prompt_tokens': prompt_tokens,
+                'completion_tokens': completion_tokens,
+                'total_tokens': prompt_tokens + completion_tokens,
+            },
+        }, ensure_ascii=False), headers=headers, content_type=APPLICATION_JSON)
+
+    # https://platform.openai.com/docs/api-reference/chat/streaming
+    async def generate():
+        await asyncio.sleep(latency)
+        yield _build_chunk(cid, model, {'role': 'assistant'})
+
+        pieces = re.findall(r'\S+\s*|\s+', content)
+        for piece in pieces:
+            await asyncio.sleep(duration / max(len(pieces), 1))
+            yield _build_chunk(cid, model, {'content': piece})
+
+        yield _build_chunk(cid, model, {}, 'stop')
+        yield 'data: [DONE]\n\n'
+
+    res = Response(generate(), headers=headers, content_type='text/event-stream')  # nopep8.
+    res.timeout = None
+    return res
+
+
+def _acquire(tokens: int) -> float:
+    waits = []
+    for name, cost, capacity in [
+        ('requests', 1, _REQUESTS_PER_MIN),
+        ('tokens', min(tokens, _TOKENS_PER_MIN), _TOKENS_PER_MIN),
+    ]:
+        bucket = _buckets[name]
+        now = time.monotonic()
+        bucket[0] = min(capacity, bucket[0] + (now - bucket[1]) * capacity / 60)  # nopep8.
+        bucket[1] = now
+        if bucket[0] < cost:
+            waits.append((cost - bucket[0]) * 60 / capacity)
+
+    if waits:
+        return max(waits)
+
+    _buckets['requests'][0] -= 1
+    _buckets['tokens'][0] -= min(tokens, _TOKENS_PER_MIN)
+    return 0
+
+
+# https://platform.openai.com/docs/guides/rate-limits/rate-limits-in-headers
+def _build_rate_limit_headers() -> dict:
+    requests_remaining = max(int(_buckets['requests'][0]), 0)
+    tokens_remaining = max(int(_buckets['tokens'][0]), 0)
+    return {
+        'x-ratelimit-limit-requests': str(_REQUESTS_PER_MIN),
+        'x-ratelimit-limit-tokens': str(_TOKENS_PER_MIN),
+        'x-ratelimit-remaining-requests': str(requests_remaining),
+        'x-ratelimit-remaining-tokens': str(tokens_remaining),
+        'x-ratelimit-reset-requests': f'{(_REQUESTS_PER_MIN - requests_remaining) * 60 / _REQUESTS_PER_MIN:.3f}s',  # nopep8.
+        'x-ratelimit-reset-tokens': f'{(_TOKENS_PER_MIN - tokens_remaining) * 60 / _TOKENS_PER_MIN:.3f}s',  # nopep8.
+    }
+
+
+def _build_error_response(status_code: int, code: str) -> Response:
+    res = Response(json.dumps({
+        'error': {
+            'message': f'mock {code}',
+            'type': code,
+            'code': code,
+        },
+    }), status=status_code, content_type=APPLICATION_JSON)
+    res.headers.update(_build_rate_limit_headers())
+    return res
+
+
+def _build_chunk(cid: str, model: str, delta: dict, finish_reason: str = None) -> str:
+    chunk = {
+        'id': cid,
+        'object': 'chat.completion.chunk',
+        'created': int(time.time()),
+        'model': model,
+        'choices': [{
+            'index': 0,
+            'delta': delta,
+            'finish_reason': finish_reason,
+        }],
+    }
+    return f'data: {json.dumps(chunk, ensure_ascii=False)}\n\n'
+
+
+# The same messages always have the same content.
+def _build_content(messages: list[dict]) -> str:
+    system = messages[0].get('content', '')
+    last = messages[-1].get('content', '')
+    digest = hashlib.sha256(json.dumps(messages, sort_keys=True).encode()).hexdigest()  # nopep8.
+    rand = random.Random(digest)
+
+    if '"end_at"' in system:
+        return _build_one_chapter(rand, last)
+    if 'outlines' in system:
+        return _build_multi_chapters(rand, last)
+    if 'refine the existing bullet list summary' in system:
+        return _build_summary(rand, last, previous=_parse_previous_summary(system))  # nopep8.
+    if 'summarize and list the most important points' in system:
+        return _build_summary(rand, last)
+    if 'merge the summaries into one bullet list summary' in system:
+        return _build_merged_summary(rand, last)
+    if 'Translate the "chapter" field' in system:
+        return _build_translation(last, lang=_parse_lang(system))
+
+    return f'mock {digest[:8]}'
+
+
+# See GENERATE_MULTI_CHAPTERS_SYSTEM_PROMPT in ./prompt.py.
+def _build_multi_chapters(rand: random.Random, content: str) -> str:
+    items: list[dict] = _loads_list(content)
+    if not items:
+        return '[]'
+
+    count = min(len(items), rand.randint(3, 8))
+    step = len(items) / count
+    res = []
+
+    for i in range(count):
+        item = items[int(i * step)]
+        start = int(item.get('start', 0))
+        res.append({
+            'outline': _build_title(item.get('text', '')),
+            'information': f'{item.get("text", "").strip()}.',
+            'start': start,
+            'timestamp': _format_timestamp(start),
+        })
+
+    return json.dumps(res, ensure_ascii=False, indent=2)
+
+
+# See GENERATE_ONE_CHAPTER_SYSTEM_PROMPT in ./prompt.py.
+def _build_one_chapter(rand: random.Random, content: str) -> str:
+    items: list[dict] = _loads_list(content)
+    if not items:
+        return json.dumps({'end_at': None})
+
+    lo = max(len(items) // 3, 1)
+    end = items[rand.randint(lo, len(items)) - 1]
+    start = int(items[0].get('start', 0))
+
+    return json.dumps({
+        'end_at': int(end.get('index', 0)),
+        'start': start,
+        'timestamp': _format_timestamp(start),
+        'outline': _build_title(items[0].get('text', '')),
+    }, ensure_ascii=False, indent=2)
+
+
+# See SUMMARIZE_FIRST_CHAPTER_SYSTEM_PROMPT and SUMMARIZE_NEXT_CHAPTER_SYSTEM_PROMPT in ./prompt.py.
+def _build_summary(rand: random.Random, content: str, previous: str = '') -> str:
+    lines = [line.strip('[] ') for line in content.splitlines()]
+    lines = [line for line in lines if line]
+    points = rand.sample(lines, min(len(lines), rand.randint(1, 3)))
+    points = [f'- {p.rstrip(".")}.' for p in points]
+
+    if previous:
+        points = previous.splitlines() + points
+    return '\n'.join(points)
+
+
+# See SUMMARIZE_MERGE_CHAPTER_SYSTEM_PROMPT in ./prompt.py.
+def _build_merged_summary(rand: random.Random, content: str) -> str:
+    points = [line.strip() for line in content.splitlines() if line.strip()]
+    points = list(dict.fromkeys(points))  # dedupe but keep order.
+    return '\n'.join(points[:rand.randint(3, 8)])
+
+
+# See _TRANSLATION_SYSTEM_PROMPT and _TRANSLATION_BATCH_SYSTEM_PROMPT in ./translation.py.
+def _build_translation(content: str, lang: str) -> str:
+    try:
+        obj: dict = json.loads(content)
+    except Exception:
+        obj = {}
+
+    if isinstance(obj, list):
+        return json.dumps([{
+            'index': o.get('index', 0),
+            'chapter': f'[{lang}] {o.get("chapter", "")}',
+            'summary': f'[{lang}] {o.get("summary", "")}',
+        } for o in obj if isinstance(o, dict)], ensure_ascii=False, indent=2)
+
+    return json.dumps({
+        'chapter': f'[{lang}] {obj.get("chapter", "")}',
+        'summary': f'[{lang}] {obj.get("summary", "")}',
+    }, ensure_ascii=False, indent=2)
+
+
+def _loads_list(content: str) -> list[dict]:
+    try:
+        res = json.loads(content)
+    except Exception:
+        return []
+    return [r for r in res if isinstance(r, dict)] if isinstance(res, list) else []  # nopep8.
+
+
+def _parse_previous_summary(system: str) -> str:
+    found = re.search(r'```\n(.*?)\n```', system, re.S)
+    return found.group(1).strip() if found else ''
+
+
+def _parse_lang(system: str) -> str:
+    found = re.search(r'to language (\S+) in BCP 47', system)
+    return found.group(1) if found else 'en'
+
+
+def _build_title(text: str) -> str:
+    words = text.strip().split()
+    return ' '.join(words[:3]).strip('.,!?') or 'Untitled'
+
+
+def _format_timestamp(seconds: int) -> str:
+    return f'{seconds // 3600:02d}:{seconds % 3600 // 60:02d}:{seconds % 60:02d}'
@@ -1,25 +1,37 @@
+import asyncio
 import httpx
+import json
 import logging
 import tiktoken
+import time
 
+from concurrent.futures import ThreadPoolExecutor
+from contextvars import ContextVar, Token
 from dataclasses import dataclass, asdict
 from enum import IntEnum, unique
+from typing import Awaitable, Callable, Optional
 from quart import abort
 from strenum import StrEnum
 from tenacity import \
+    RetryCallState, \
     after_log, \
     retry, \
     retry_if_exception_type, \
     stop_after_attempt, \
-    wait_fixed
+    wait_random_exponential
 from werkzeug.exceptions import \
     BadGateway, \
+    HTTPException, \
     ServiceUnavailable, \
     TooManyRequests
 
+from chat_cache import build_chat_cache_digest, get_or_fetch_chat_cache
+from circuit_breaker import CircuitBreaker
 from constants import APPLICATION_JSON, USER_AGENT
 from logger import logger
-from rds import rds, KEY_OPENAI_API_KEY
+from rate_limit import update_rate_limit, wait_for_rate_limit
+from rds import rds, KEY_OPENAI_API_BASE, KEY_OPENAI_API_KEY
+from scheduler import Scheduler
 
 
 # https://platform.openai.com/docs/models/overview
@@ -53,24 +65,209 @@ class Message:
 
 
 # https://platform.openai.com/docs/api-reference/chat/create
-_CHAT_API_URL = 'https://api.openai.com/v1/chat/completions'
+_DEFAULT_API_BASE = 'https://api.openai.com/v1'
 _encoding_for_chat = tiktoken.get_encoding('cl100k_base')
 
+# tiktoken releases the GIL while encoding, so encode large texts in threads
+# instead of blocking the event loop; at most 2 batches with 4 threads each.
+_TOKENIZER_MAX_WORKERS = 2
+_TOKENIZER_BATCH_THREADS = 4
+# Encoding small texts inline is faster than switching threads.
+_TOKENIZER_INLINE_MAX_LENGTH = 4096  # in characters.
+_tokenizer_executor = ThreadPoolExecutor(
+    max_workers=_TOKENIZER_MAX_WORKERS,
+    thread_name_prefix='tokenizer',
+)
+
+# https://www.python-httpx.org/advanced/#pool-limit-configuration
+_CHAT_MAX_CONNECTIONS = 100
+_CHAT_MAX_KEEPALIVE_CONNECTIONS = 20
+_CHAT_KEEPALIVE_EXPIRY = 60  # in seconds.
+# https://www.python-httpx.org/http2
+_CHAT_HTTP2 = True
+
+_chat_client: Optional[httpx.AsyncClient] = None
+
+# Absolute time.monotonic() all chat() in current context must finish before,
+# asyncio tasks (e.g. created by asyncio.gather) inherit it from their creator.
+_chat_deadline: ContextVar[Optional[float]] = ContextVar('chat_deadline', default=None)  # nopep8.
+
+# (key, priority) to schedule chat() in current context, see set_chat_schedule.
+_chat_schedule: ContextVar[Optional[tuple[str, int]]] = ContextVar('chat_schedule', default=None)  # nopep8.
+# Max concurrent scheduled chat() of the whole process.
+_CHAT_SCHEDULER_MAX_CONCURRENCY = 16
+_chat_scheduler = Scheduler(name='chat', max_concurrency=_CHAT_SCHEDULER_MAX_CONCURRENCY)  # nopep8.
+
+# Fail fast if the upstream keeps failing.
+_chat_breaker = CircuitBreaker(name='chat')
+
+
+def _is_http2_available() -> bool:
+    try:
+        import h2  # noqa: F401
+        return True
+    except ImportError:
+        return False
+
+
+# Keep one long-lived client per process, reuse its connections across requests.
+async def open_chat_client(
+    max_connections: int = _CHAT_MAX_CONNECTIONS,
+    max_keepalive_connections: int = _CHAT_MAX_KEEPALIVE_CONNECTIONS,
+    keepalive_expiry: float = _CHAT_KEEPALIVE_EXPIRY,
+    http2: bool = _CHAT_HTTP2,
+) -> httpx.AsyncClient:
+    global _chat_client
+    if _chat_client and not _chat_client.is_closed:
+        return _chat_client
+
+    if http2 and not _is_http2_available():
+        logger.warning(f'open chat client, but "h2" not installed, fallback to http/1.1')  # nopep8.
+        http2 = False
+
+    limits = httpx.Limits(
+        max_connections=max_connections,
+        max_keepalive_connections=max_keepalive_connections,
+        keepalive_expiry=keepalive_expiry,
+    )
+
+    # Don't retry here, chat() has its own retry policy.
+    transport = httpx.AsyncHTTPTransport(
+        retries=0,
+        http2=http2,
+        limits=limits,
+    )
+
+    _chat_client = httpx.AsyncClient(
+        transport=transport,
+        http2=http2,
+        limits=limits,
+    )
+
+    logger.info(f'open chat client, '
+                f'http2={http2}, '
+                f'max_connections={max_connections}, '
+                f'max_keepalive_connections={max_keepalive_connections}, '
+                f'keepalive_expiry={keepalive_expiry}')
+    return _chat_client
+
+
+async def close_chat_client():
+    global _chat_client
+    if not _chat_client:
+        return
+
+    logger.info(f'close chat client, stats={get_chat_client_stats()}')
+    await _chat_client.aclose()
+    _chat_client = None
+
+
+# https://www.encode.io/httpcore/connection-pools/#pool-state
+def get_chat_client_stats() -> dict:
+    stats = {
+        'connections': 0,
+        'active': 0,
+        'idle': 0,
+        'max_connections': _CHAT_MAX_CONNECTIONS,
+    }
+
+    if not _chat_client or _chat_client.is_closed:
+        return stats
+
+    pool = getattr(_chat_client._transport, '_pool', None)
+    if not pool:
+        return stats
+
+    connections = list(pool.connections)
+    idle = len([c for c in connections if c.is_idle()])
+    stats['connections'] = len(connections)
+    stats['active'] = len(connections) - idle
+    stats['idle'] = idle
+    return stats
+
+
+# Any OpenAI compatible backend can be used by setting "openai_api_base" in redis,
+# e.g. the local mock server in ./mock_openai.py for offline benchmarking.
+def get_chat_api_url() -> str:
+    api_base = rds.get(KEY_OPENAI_API_BASE)
+    api_base = api_base.decode().strip() if api_base else ''
+    api_base = api_base or _DEFAULT_API_BASE
+    return f'{api_base.rstrip("/")}/chat/completions'
+
+
+def set_chat_deadline(seconds: float) -> Token:
+    return _chat_deadline.set(time.monotonic() + seconds)
+
+
+def reset_chat_deadline(token: Token):
+    _chat_deadline.reset(token)
+
+
+# Returns None if there is no deadline.
+def get_chat_deadline_remaining() -> Optional[float]:
+    deadline = _chat_deadline.get()
+    return deadline - time.monotonic() if deadline is not None else None
+
+
+# Share the concurrency of chat() in current context with the others fairly by key (e.g. vid),
+# the lower priority the earlier within the same key; chat() is not scheduled if not set.
+def set_chat_schedule(key: str, priority: int = 0) -> Token:
+    return _chat_schedule.set((key, priority))
+
+
+def reset_chat_schedule(token: Token):
+    _chat_schedule.reset(token)
+
+
+def get_chat_scheduler_stats() -> dict:
+    return _chat_scheduler.get_stats()
+
 
 def build_message(role: Role, content: str) -> Message:
     return Message(role=role.value, content=content.strip())
 
 
+def count_text_tokens(text: str) -> int:
+    return len(_encoding_for_chat.encode(text))
+
+
+# Same as count_text_tokens() for every text, but doesn't block the event loop.
+async def count_texts_tokens(texts: list[str]) -> list[int]:
+    if sum(len(t) for t in texts) <= _TOKENIZER_INLINE_MAX_LENGTH:
+        return [count_text_tokens(t) for t in texts]
+
+    loop = asyncio.get_running_loop()
+    return await loop.run_in_executor(_tokenizer_executor, _count_texts_tokens, texts)  # nopep8.
+
+
+def _count_texts_tokens(texts: list[str]) -> list[int]:
+    res = _encoding_for_chat.encode_batch(texts, num_threads=_TOKENIZER_BATCH_THREADS)  # nopep8.
+    return [len(tokens) for tokens in res]
+
+
+# Same as count_tokens(), but doesn't block the event loop.
+async def count_tokens_async(messages: list[Message]) -> int:
+    texts: list[str] = []
+    for message in messages:
+        texts.extend(asdict(message).values())
+
+    counts = await count_texts_tokens(texts)
+    return count_tokens(messages, counts=counts)
+
+
 # https://platform.openai.com/docs/guides/chat/introduction
-def count_tokens(messages: list[Message]) -> int:
+def count_tokens(messages: list[Message], counts: Optional[list[int]] = None) -> int:
     tokens_count = 0
+    i = 0
 
     for message in messages:
         # Every message follows "<im_start>{role/name}\n{content}<im_end>\n".
         tokens_count += 4
 
         for key, value in asdict(message).items():
-            tokens_count += len(_encoding_for_chat.encode(value))
+            # Use the precomputed counts if any, in the same order.
+            tokens_count += counts[i] if counts is not None else count_text_tokens(value)
+            i += 1
 
             # If there's a "name", the "role" is omitted.
             if key == 'name':
@@ -84,6 +281,68 @@ def count_tokens(messages: list[Message]) -> int:
 
 
 # https://platform.openai.com/docs/api-reference/chat/create
+#
+# The same request (model, top_p and messages) returns the cached body if `cache`,
+# and the concurrent same requests only call upstream once.
+async def chat(
+    messages: list[Message],
+    model: Model = Model.GPT_3_5_TURBO,
+    top_p: float = 0.8,  # [0, 1]
+    timeout: int = 10,
+    api_key: str = '',
+    stream: bool = False,
+    on_content: Optional[Callable[[str], Awaitable[None]]] = None,
+    cache: bool = True,
+) -> dict:
+    url = get_chat_api_url()
+
+    async def fetch() -> dict:
+        return await _chat(
+            url=url,
+            messages=messages,
+            model=model,
+            top_p=top_p,
+            timeout=timeout,
+            api_key=api_key,
+            stream=stream,
+            on_content=on_content,
+        )
+
+    # Always write the fresh result, even if not read from the cache.
+    digest = build_chat_cache_digest(
+        url=url,
+        model=model.value,
+        top_p=top_p,
+        messages=list(map(lambda m: asdict(m), messages)),
+    )
+
+    body, hit = await get_or_fetch_chat_cache(
+        digest=digest,
+        fetch=fetch,
+        read=cache,
+        timeout=get_chat_deadline_remaining(),
+    )
+    if hit and on_content:
+        await on_content(get_content(body))
+
+    return body
+
+
+# https://aws.amazon.com/blogs/architecture/exponential-backoff-and-jitter
+_wait_random_exponential = wait_random_exponential(multiplier=0.5, max=20)
+
+
+def _wait_before_deadline(retry_state: RetryCallState) -> float:
+    wait = _wait_random_exponential(retry_state)
+    remaining = get_chat_deadline_remaining()
+    return wait if remaining is None else max(min(wait, remaining), 0)
+
+
+def _stop_after_deadline(retry_state: RetryCallState) -> bool:
+    remaining = get_chat_deadline_remaining()
+    return remaining is not None and remaining <= 0
+
+
 @retry(
     retry=retry_if_exception_type((
         httpx.ConnectError,
@@ -91,16 +350,19 @@ def count_tokens(messages: list[Message]) -> int:
         ServiceUnavailable,
         TooManyRequests,
     )),
-    wait=wait_fixed(1),  # wait 1 second between retries.
-    stop=stop_after_attempt(5),  # stopping after 5 attempts.
+    wait=_wait_before_deadline,  # exponential backoff with full jitter.
+    stop=stop_after_attempt(5) | _stop_after_deadline,  # stopping after 5 attempts or deadline.
     after=after_log(logger, logging.INFO),
 )
-async def chat(
+async def _chat(
+    url: str,
     messages: list[Message],
     model: Model = Model.GPT_3_5_TURBO,
     top_p: float = 0.8,  # [0, 1]
     timeout: int = 10,
     api_key: str = '',
+    stream: bool = False,
+    on_content: Optional[Callable[[str], Awaitable[None]]] = None,
 ) -> dict:
     if not api_key:
         api_key = rds.get(KEY_OPENAI_API_KEY).decode()
@@ -117,27 +379,184 @@ async def chat(
         'messages': list(map(lambda m: asdict(m), messages)),
         'model': model.value,
         'top_p': top_p,
+        'stream': stream,
     }
 
-    transport = httpx.AsyncHTTPTransport(retries=2)
-    client = httpx.AsyncClient(transport=transport)
+    client = await open_chat_client()
+
+    stats = get_chat_client_stats()
+    if stats['active'] >= stats['max_connections']:
+        logger.warning(f'chat, connection pool exhausted, stats={stats}')
 
+    # Wait for the rate limit shared by all processes before every attempt.
     try:
-        response = await client.post(
-            url=_CHAT_API_URL,
-            headers=headers,
-            json=body,
-            follow_redirects=True,
-            timeout=timeout,
+        await asyncio.wait_for(
+            wait_for_rate_limit(
+                api_key=api_key,
+                model=model.value,
+                tokens=await count_tokens_async(messages),
+            ),
+            timeout=get_chat_deadline_remaining(),
         )
+    except asyncio.TimeoutError:
+        abort(504, f'chat, wait for rate limit exceeded deadline')
+
+    # Take the slot per attempt, so that it's never held during backoff or rate limit waits.
+    schedule = _chat_schedule.get()
+    if schedule is not None:
+        try:
+            await asyncio.wait_for(
+                _chat_scheduler.acquire(*schedule),
+                timeout=get_chat_deadline_remaining(),
+            )
+        except asyncio.TimeoutError:
+            abort(504, f'chat, wait for schedule exceeded deadline')
+
+    try:
+        # The timeout cut short by the deadline says nothing about the upstream.
+        shortened = False
+        remaining = get_chat_deadline_remaining()
+        if remaining is not None:
+            if remaining <= 0:
+                abort(504, f'chat, exceeded deadline')
+            if remaining < timeout:
+                timeout = remaining
+                shortened = True
+
+        probe = _chat_breaker.before_call()
+        healthy: Optional[bool] = None
+
+        try:
+            if stream:
+                res = await _chat_stream(
+                    client=client,
+                    url=url,
+                    headers=headers,
+                    body=body,
+                    timeout=timeout,
+                    api_key=api_key,
+                    on_content=on_content,
+                )
+            else:
+                response = await client.post(
+                    url=url,
+                    headers=headers,
+                    json=body,
+                    follow_redirects=True,
+                    timeout=timeout,
+                )
+
+                await update_rate_limit(
+                    api_key=api_key,
+                    model=model.value,
+                    headers=response.headers,
+                    status_code=response.status_code,
+                )
+
+                if response.status_code not in range(200, 400):
+                    abort(response.status_code, response.text)
+
+                # Automatically .aclose() if the response body is read to completion.
+                res = response.json()
+
+            healthy = True
+        except httpx.TimeoutException:
+            healthy = None if shortened else False
+            raise
+        except httpx.TransportError:
+            healthy = False
+            raise
+        except HTTPException as e:
+            healthy = e.code < 500
+            raise
+        finally:
+            _chat_breaker.record(healthy, probe)
     finally:
-        await client.aclose()
+        if schedule is not None:
+            _chat_scheduler.release()
+
+    return res
+
 
-    if response.status_code not in range(200, 400):
-        abort(response.status_code, response.text)
+# https://platform.openai.com/docs/api-reference/chat/streaming
+#
+# Returns the same body as non-stream mode, so that get_content(body) still works;
+# on_content(content) is called with the content received so far for every delta.
+#
+# The stream cut off without "[DONE]" or finish_reason is retried as a bad gateway,
+# never returned with the partial content.
+async def _chat_stream(
+    client: httpx.AsyncClient,
+    url: str,
+    headers: dict,
+    body: dict,
+    timeout: int,
+    api_key: str,
+    on_content: Optional[Callable[[str], Awaitable[None]]] = None,
+) -> dict:
+    role = Role.ASSISTANT.value
+    content = ''
+    finish_reason = None
+    done = False
+
+    async with client.stream(
+        method='POST',
+        url=url,
+        headers=headers,
+        json=body,
+        follow_redirects=True,
+        timeout=timeout,
+    ) as response:
+        await update_rate_limit(
+            api_key=api_key,
+            model=body['model'],
+            headers=response.headers,
+            status_code=response.status_code,
+        )
+
+        if response.status_code not in range(200, 400):
+            await response.aread()
+            abort(response.status_code, response.text)
+
+        async for line in response.aiter_lines():
+            line = line.strip()
+            if not line.startswith('data:'):
+                continue  # empty line or comment.
+
+            data = line[len('data:'):].strip()
+            if data == '[DONE]':
+                done = True
+                break
 
-    # Automatically .aclose() if the response body is read to completion.
-    return response.json()
+            choices: list[dict] = json.loads(data).get('choices', [])
+            if not choices:
+                continue
+
+            delta: dict = choices[0].get('delta', {})
+            role = delta.get('role', role)
+            finish_reason = choices[0].get('finish_reason') or finish_reason
+
+            piece = delta.get('content')
+            if not piece:
+                continue
+
+            content += piece
+            if on_content:
+                await on_content(content)
+
+    if not done and not finish_reason:
+        abort(502, f'chat stream, but cut off, len(content)={len(content)}')
+
+    return {
+        'choices': [{
+            'index': 0,
+            'message': {
+                'role': role,
+                'content': content,
+            },
+            'finish_reason': finish_reason,
+        }],
+    }
 
 
 def get_content(body: dict) -> str:
@@ -206,6 +206,24 @@ Do not output any redundant or irrelevant points.
 Do not output any redundant explanation or information.
 '''
 
+# Merge the partial summaries of the same chapter, see summary._merge_summaries.
+SUMMARIZE_MERGE_CHAPTER_TOKEN_LIMIT = TokenLimit.GPT_3_5_TURBO * 5 / 8  # nopep8, 2560.
+SUMMARIZE_MERGE_CHAPTER_SYSTEM_PROMPT = '''
+We have provided some bullet list summaries of consecutive parts of video subtitles about "{chapter}",
+the summaries are separated by a blank line, from top to bottom.
+
+Please merge the summaries into one bullet list summary of the most important points.
+
+The output format should be a markdown bullet list, and each bullet point should end with a period.
+The output language should be "{lang}" in BCP 47.
+
+Please merge similar viewpoints before the final output.
+Please keep the output clear and accurate.
+
+Do not output any redundant or irrelevant points.
+Do not output any redundant explanation or information.
+'''
+
 
 def generate_multi_chapters_example_messages_for_4k(lang: str) -> list[Message]:
     system_prompt = _GENERATE_MULTI_CHAPTERS_SYSTEM_PROMPT.format(lang=lang)
@@ -0,0 +1,204 @@
+import asyncio
+import hashlib
+import random
+import re
+
+from typing import Optional
+
+from httpx import Headers
+
+from logger import logger
+from rds import ards
+
+# https://platform.openai.com/docs/guides/rate-limits/overview
+#
+# Only the initial capacities (requests per min, tokens per min),
+# they will be replaced by the "x-ratelimit-limit-*" response headers.
+_DEFAULT_LIMITS = {
+    'gpt-3.5-turbo': (3500, 90000),
+    'gpt-3.5-turbo-16k': (3500, 180000),
+    'gpt-4': (200, 40000),
+    'gpt-4-32k': (200, 80000),
+}
+_DEFAULT_LIMIT = (200, 40000)
+
+_RATE_LIMIT_RDS_KEY_EX = 10 * 60  # 10 mins.
+_RATE_LIMIT_MAX_SLEEP = 5  # in seconds, check again after sleeping.
+
+# Token bucket refilled at capacity per minute,
+# the state is shared by the app and all arq workers.
+_REFILL_LUA = '''
+local t = redis.call('TIME')
+local now = tonumber(t[1]) + tonumber(t[2]) / 1000000
+
+local function refill(key, default_capacity, limit)
+    local b = redis.call('HMGET', key, 'tokens', 'capacity', 'updated_at', 'blocked_until')
+    local capacity = tonumber(limit) or tonumber(b[2]) or default_capacity
+    local tokens = tonumber(b[1]) or capacity
+    local updated_at = tonumber(b[3]) or now
+    local blocked_until = tonumber(b[4]) or 0
+    tokens = math.min(capacity, tokens + (now - updated_at) * capacity / 60)
+    return tokens, capacity, blocked_until
+end
+
+local function save(key, tokens, capacity, blocked_until)
+    redis.call('HSET', key,
+        'tokens', tostring(tokens),
+        'capacity', tostring(capacity),
+        'updated_at', tostring(now),
+        'blocked_until', tostring(blocked_until))
+    redis.call('EXPIRE', key, ARGV[1])
+end
+'''
+
+# KEYS: requests bucket, tokens bucket.
+# ARGV: ex, default requests capacity, default tokens capacity, tokens cost.
+# Returns the seconds to wait as string, or "0" if acquired.
+_ACQUIRE_LUA = _REFILL_LUA + '''
+local rt, rc, rb = refill(KEYS[1], tonumber(ARGV[2]), nil)
+local tt, tc, tb = refill(KEYS[2], tonumber(ARGV[3]), nil)
+
+-- Never wait forever for the request larger than the capacity.
+local cost = math.min(tonumber(ARGV[4]), tc)
+local wait = math.max(rb - now, tb - now, 0)
+
+if wait <= 0 then
+    if rt < 1 then
+        wait = math.max(wait, (1 - rt) * 60 / rc)
+    end
+    if tt < cost then
+        wait = math.max(wait, (cost - tt) * 60 / tc)
+    end
+end
+
+if wait <= 0 then
+    rt = rt - 1
+    tt = tt - cost
+end
+
+save(KEYS[1], rt, rc, rb)
+save(KEYS[2], tt, tc, tb)
+return tostring(wait)
+'''
+
+# KEYS: requests bucket, tokens bucket.
+# ARGV: ex, default requests capacity, default tokens capacity,
+#       requests limit, requests remaining, tokens limit, tokens remaining,
+#       requests retry after, tokens retry after; empty string if unknown.
+_UPDATE_LUA = _REFILL_LUA + '''
+local function update(key, default_capacity, limit, remaining, retry_after)
+    local tokens, capacity, blocked_until = refill(key, default_capacity, limit)
+    if tonumber(remaining) then
+        tokens = math.min(tokens, tonumber(remaining))
+    end
+    if tonumber(retry_after) then
+        blocked_until = math.max(blocked_until, now + tonumber(retry_after))
+    end
+    save(key, tokens, capacity, blocked_until)
+end
+
+update(KEYS[1], tonumber(ARGV[2]), ARGV[4], ARGV[5], ARGV[8])
+update(KEYS[2], tonumber(ARGV[3]), ARGV[6], ARGV[7], ARGV[9])
+return 1
+'''
+
+_acquire_script = ards.register_script(_ACQUIRE_LUA)
+_update_script = ards.register_script(_UPDATE_LUA)
+
+
+# Different API keys have different rate limits.
+def build_rate_limit_rds_keys(api_key: str, model: str) -> tuple[str, str]:
+    digest = hashlib.sha256(api_key.encode()).hexdigest()[:16]
+    return (
+        f'rate_limit_requests_{digest}_{model}',
+        f'rate_limit_tokens_{digest}_{model}',
+    )
+
+
+# Wait until both the requests bucket and the tokens bucket are available.
+async def wait_for_rate_limit(api_key: str, model: str, tokens: int):
+    keys = build_rate_limit_rds_keys(api_key, model)
+    requests_capacity, tokens_capacity = _DEFAULT_LIMITS.get(model, _DEFAULT_LIMIT)  # nopep8.
+    waited = 0
+
+    while True:
+        wait = await _acquire_script(keys=keys, args=[
+            _RATE_LIMIT_RDS_KEY_EX,
+            requests_capacity,
+            tokens_capacity,
+            tokens,
+        ])
+
+        wait = float(wait)
+        if wait <= 0:
+            break
+
+        # Add jitter to avoid all waiters waking up in lockstep.
+        wait = min(wait, _RATE_LIMIT_MAX_SLEEP)
+        wait += random.uniform(0, wait * 0.1 + 0.05)
+        waited += wait
+        await asyncio.sleep(wait)
+
+    if waited > 0:
+        logger.info(f'wait for rate limit, model={model}, tokens={tokens}, waited={waited:.2f}')  # nopep8.
+
+
+# https://platform.openai.com/docs/guides/rate-limits/rate-limits-in-headers
+async def update_rate_limit(api_key: str, model: str, headers: Headers, status_code: int = 200):
+    keys = build_rate_limit_rds_keys(api_key, model)
+    requests_capacity, tokens_capacity = _DEFAULT_LIMITS.get(model, _DEFAULT_LIMIT)  # nopep8.
+
+    requests_retry_after: Optional[float] = None
+    tokens_retry_after: Optional[float] = None
+
+    if status_code == 429:
+        retry_after = _parse_float(headers.get('retry-after'))
+        if retry_after is not None:
+            requests_retry_after = retry_after
+            tokens_retry_after = retry_after
+        else:
+            requests_retry_after = _parse_duration(headers.get('x-ratelimit-reset-requests'))  # nopep8.
+            tokens_retry_after = _parse_duration(headers.get('x-ratelimit-reset-tokens'))  # nopep8.
+        logger.warning(f'update rate limit, too many requests, '
+                       f'model={model}, '
+                       f'requests_retry_after={requests_retry_after}, '
+                       f'tokens_retry_after={tokens_retry_after}')
+
+    await _update_script(keys=keys, args=[
+        _RATE_LIMIT_RDS_KEY_EX,
+        requests_capacity,
+        tokens_capacity,
+        _to_arg(_parse_float(headers.get('x-ratelimit-limit-requests'))),
+        _to_arg(_parse_float(headers.get('x-ratelimit-remaining-requests'))),
+        _to_arg(_parse_float(headers.get('x-ratelimit-limit-tokens'))),
+        _to_arg(_parse_float(headers.get('x-ratelimit-remaining-tokens'))),
+        _to_arg(requests_retry_after),
+        _to_arg(tokens_retry_after),
+    ])
+
+
+def _parse_float(value: Optional[str]) -> Optional[float]:
+    try:
+        return float(value) if value else None
+    except ValueError:
+        return None
+
+
+# Duration like "1s", "6m0s", "20ms", "1h2m3.5s".
+def _parse_duration(value: Optional[str]) -> Optional[float]:
+    if not value:
+        return None
+
+    units = {'h': 3600, 'm': 60, 's': 1, 'ms': 0.001}
+    parts = re.findall(r'([\d.]+)(ms|h|m|s)', value)
+    if not parts:
+        return None
+
+    try:
+        return sum(float(n) * units[u] for n, u in parts)
+    except ValueError:
+        return None
+
+
+def _to_arg(value: Optional[float]) -> str:
+    return '' if value is None else str(value)
@@ -4,6 +4,8 @@ import redis
 from redis import asyncio as aioredis
 
 KEY_OPENAI_API_KEY = 'openai_api_key'  # string.
+KEY_OPENAI_API_BASE = 'openai_api_base'  # string, optional.
+KEY_TRANSLATION_PRECOMPUTE_TOKENS = 'translation_precompute_tokens'  # int, optional; tokens per day, 0 to disable.
 
 # Default host and port.
 rds = redis.from_url('redis://localhost:6379')
@@ -0,0 +1,74 @@
+import asyncio
+
+from collections import deque
+from heapq import heappop, heappush
+from itertools import count
+
+from logger import logger
+
+
+# Bounds the concurrent calls of a whole process, and shares them fairly:
+#
+#   * between keys (e.g. vid) by round-robin, one call per key per turn;
+#   * within the same key by priority, the lower the earlier.
+#
+# The slot is handed over to the next waiter directly on release,
+# so that a new caller can't cut in line.
+class Scheduler:
+    def __init__(self, name: str, max_concurrency: int):
+        self._name = name
+        self._max_concurrency = max_concurrency
+        self._running = 0
+        self._seq = count()
+        # Waiters of every key, heap of (priority, seq, future).
+        self._waiters: dict[str, list[tuple[int, int, asyncio.Future]]] = {}
+        # Keys which have waiters, in round-robin order.
+        self._turns: deque[str] = deque()
+
+    def get_stats(self) -> dict:
+        return {
+            'running': self._running,
+            'waiting': sum(not f.done() for w in self._waiters.values() for _, _, f in w),  # nopep8.
+            'keys': len(self._waiters),
+            'max_concurrency': self._max_concurrency,
+        }
+
+    async def acquire(self, key: str, priority: int = 0):
+        if self._running < self._max_concurrency and not self._turns:
+            self._running += 1
+            return
+
+        future = asyncio.get_running_loop().create_future()
+        if key not in self._waiters:
+            self._waiters[key] = []
+            self._turns.append(key)
+        heappush(self._waiters[key], (priority, next(self._seq), future))
+
+        try:
+            await future
+        except asyncio.CancelledError:
+            # The slot has been handed over just before cancelled, pass it on;
+            # otherwise the cancelled future is skipped by release().
+            if future.done() and not future.cancelled():
+                self.release()
+            raise
+
+    def release(self):
+        while self._turns:
+            key = self._turns.popleft()
+            waiters = self._waiters[key]
+            _, _, future = heappop(waiters)
+
+            if waiters:
+                self._turns.append(key)
+            else:
+                del self._waiters[key]
+
+            if not future.done():
+                future.set_result(None)
+                return  # hand over the slot.
+
+        self._running -= 1
+        if self._running < 0:
+            logger.error(f'scheduler, released too many times, name={self._name}')  # nopep8.
+            self._running = 0
@@ -0,0 +1,183 @@
+import asyncio
+import async_timeout
+
+from typing import Awaitable, Callable, Optional, TypeVar
+from uuid import uuid4
+
+from lease import acquire_lease, keep_lease, release_lease
+from logger import logger
+from rds import ards
+
+T = TypeVar('T')
+
+_SINGLE_FLIGHT_LEASE_EX = 60  # in seconds.
+_SINGLE_FLIGHT_LEASE_INTERVAL = 20  # in seconds.
+# Check again even without any wake-up, in case the leader crashed before publishing.
+_SINGLE_FLIGHT_WAIT_INTERVAL = 5  # in seconds.
+_SINGLE_FLIGHT_HUB_READ_TIMEOUT = 1  # in seconds.
+_SINGLE_FLIGHT_HUB_RECONNECT_INTERVAL = 1  # in seconds.
+_SINGLE_FLIGHT_CHANNEL_PATTERN = 'single_flight_channel_*'
+
+
+def build_single_flight_lease_rds_key(key: str) -> str:
+    return f'single_flight_lease_{key}'
+
+
+def build_single_flight_channel(key: str) -> str:
+    return f'single_flight_channel_{key}'
+
+
+# One pattern subscription per process, the followers are woken up in memory,
+# so that the Redis connections don't grow with the followers, see _SseHub in ./sse.py.
+class _SingleFlightHub:
+    def __init__(self):
+        self.woken = 0
+        self._waiters: dict[str, set[asyncio.Event]] = {}
+        self._task: Optional[asyncio.Task] = None
+
+    def start(self):
+        self._task = asyncio.create_task(self._run())
+
+    async def stop(self):
+        if self._task:
+            self._task.cancel()
+            await asyncio.gather(self._task, return_exceptions=True)
+            self._task = None
+
+    def watch(self, channel: str) -> asyncio.Event:
+        event = asyncio.Event()
+        self._waiters.setdefault(channel, set()).add(event)
+        return event
+
+    def unwatch(self, channel: str, event: asyncio.Event):
+        events = self._waiters.get(channel)
+        if events is None:
+            return
+        events.discard(event)
+        if not events:
+            del self._waiters[channel]
+
+    def get_stats(self) -> dict:
+        return {
+            'channels': len(self._waiters),
+            'waiters': sum(len(e) for e in self._waiters.values()),
+            'woken': self.woken,
+        }
+
+    async def _run(self):
+        while True:
+            pubsub = ards.pubsub()
+            try:
+                await pubsub.psubscribe(_SINGLE_FLIGHT_CHANNEL_PATTERN)
+                logger.info(f'single flight hub, psubscribe, pattern={_SINGLE_FLIGHT_CHANNEL_PATTERN}')  # nopep8.
+
+                while True:
+                    obj = await pubsub.get_message(
+                        ignore_subscribe_messages=True,
+                        timeout=_SINGLE_FLIGHT_HUB_READ_TIMEOUT,
+                    )
+                    if isinstance(obj, dict):
+                        self._wake(obj['channel'].decode())
+            except asyncio.CancelledError:
+                raise
+            except Exception:
+                # The wake-ups published during reconnecting are lost,
+                # the followers check again after _SINGLE_FLIGHT_WAIT_INTERVAL.
+                logger.exception(f'single flight hub failed, reconnect')
+                await asyncio.sleep(_SINGLE_FLIGHT_HUB_RECONNECT_INTERVAL)
+            finally:
+                await pubsub.close()
+
+    def _wake(self, channel: str):
+        for event in self._waiters.get(channel, ()):
+            event.set()
+            self.woken += 1
+
+
+_single_flight_hub: Optional[_SingleFlightHub] = None
+
+
+# Without the hub, e.g. in the workers, the followers only check every _SINGLE_FLIGHT_WAIT_INTERVAL.
+async def open_single_flight_hub():
+    global _single_flight_hub
+    if _single_flight_hub:
+        return
+
+    _single_flight_hub = _SingleFlightHub()
+    _single_flight_hub.start()
+
+
+async def close_single_flight_hub():
+    global _single_flight_hub
+    if not _single_flight_hub:
+        return
+
+    logger.info(f'close single flight hub, stats={_single_flight_hub.get_stats()}')  # nopep8.
+    await _single_flight_hub.stop()
+    _single_flight_hub = None
+
+
+# Only one caller (the leader) across all processes fetches the same key at the same time,
+# the others (the followers) are woken up by the hub when the leader finished,
+# then load the leader's result instead of fetching again.
+#
+# The fetch must save its result where the load can find it;
+# the load returns None if not found.
+async def single_flight(
+    key: str,
+    load: Callable[[], Awaitable[Optional[T]]],
+    fetch: Callable[[], Awaitable[T]],
+) -> T:
+    res = await load()
+    if res is not None:
+        return res
+
+    lease_key = build_single_flight_lease_rds_key(key)
+    channel = build_single_flight_channel(key)
+    token = str(uuid4())
+
+    # Watch before checking the lease, so that the wake-up is never missed.
+    hub = _single_flight_hub
+    event = hub.watch(channel) if hub else asyncio.Event()
+
+    try:
+        while True:
+            if await acquire_lease(lease_key, token, _SINGLE_FLIGHT_LEASE_EX):
+                break
+
+            try:
+                async with async_timeout.timeout(_SINGLE_FLIGHT_WAIT_INTERVAL):
+                    await event.wait()
+            except asyncio.TimeoutError:
+                pass
+
+            woken = event.is_set()
+            event.clear()
+
+            res = await load()
+            if res is not None:
+                logger.info(f'single flight, coalesced, key={key}, woken={woken}')  # nopep8.
+                return res
+
+            # Otherwise the leader failed, or is still fetching; try to become the leader.
+    finally:
+        if hub:
+            hub.unwatch(channel, event)
+
+    heartbeat = asyncio.create_task(keep_lease(
+        key=lease_key,
+        token=token,
+        ex=_SINGLE_FLIGHT_LEASE_EX,
+        interval=_SINGLE_FLIGHT_LEASE_INTERVAL,
+    ))
+
+    try:
+        # The previous leader may have finished just now.
+        res = await load()
+        if res is not None:
+            return res
+        return await fetch()
+    finally:
+        heartbeat.cancel()
+        await release_lease(lease_key, token)
+        await ards.publish(channel, token)
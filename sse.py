@@ -1,18 +1,31 @@
+import asyncio
 import async_timeout
 import json
 
+from collections import OrderedDict
 from dataclasses import dataclass, asdict, field
 from enum import unique
+from fnmatch import fnmatchcase
+from typing import Hashable, Optional
 
 from strenum import StrEnum
 
 from logger import logger
 from rds import ards
 
+# Messages buffered for every client after collapsing, see _SseSubscriber;
+# the oldest ones are dropped only if the client is still too slow.
+SSE_SUBSCRIBER_QUEUE_SIZE = 64
+_SSE_SUBSCRIBE_TIMEOUT = 300  # 5 mins.
+_SSE_HUB_READ_TIMEOUT = 1  # in seconds.
+_SSE_HUB_RECONNECT_INTERVAL = 1  # in seconds.
+
 
 @unique
 class SseEvent(StrEnum):
     SUMMARY = 'summary'
+    TRANSCRIPT = 'transcript'
+    TRANSLATION = 'translation'
     CLOSE = 'close'
 
 
@@ -34,15 +47,207 @@ async def sse_publish(channel: str, event: SseEvent, data: dict or list[dict] =
     await ards.publish(channel=channel, message=message)
 
 
-# https://aioredis.readthedocs.io/en/latest/getting-started/#pubsub-mode
+# The pending messages of a slow client are collapsed by key, the newer one replaces
+# the older one and moves to the end, so the client still receives them in order:
+#
+# - a summary message of a single chapter, i.e. the per-chapter update, by its cid;
+# - a summary message of other chapters, i.e. the full snapshot;
+# - a transcript message, the latest state;
+# - never collapses others, e.g. the close message.
+#
+# The client merges the chapters by cid, so the latest per chapter plus the latest
+# full snapshot leave it in the same state as receiving all of them.
+def _build_collapse_key(message: SseMessage) -> Optional[Hashable]:
+    if message.event == SseEvent.SUMMARY and isinstance(message.data, dict):
+        chapters = message.data.get('chapters') or []
+        if len(chapters) == 1:
+            return message.event, chapters[0].get('cid')
+        return message.event,
+    if message.event == SseEvent.TRANSCRIPT:
+        return message.event,
+    return None
+
+
+class _SseSubscriber:
+    def __init__(self):
+        self._pending: OrderedDict[Hashable, tuple[str, str]] = OrderedDict()
+        self._seq = 0  # the keys of the messages never collapsed.
+        self._ready = asyncio.Event()
+
+    # Returns (collapsed, dropped).
+    def put(self, key: Optional[Hashable], item: tuple[str, str]) -> tuple[bool, bool]:  # nopep8.
+        if key is None:
+            key = self._seq
+            self._seq += 1
+
+        collapsed = self._pending.pop(key, None) is not None
+        self._pending[key] = item
+        self._ready.set()
+
+        dropped = len(self._pending) > SSE_SUBSCRIBER_QUEUE_SIZE
+        if dropped:
+            self._pending.popitem(last=False)
+        return collapsed, dropped
+
+    # Returns (event, rendered message).
+    async def get(self) -> tuple[str, str]:
+        while not self._pending:
+            self._ready.clear()
+            await self._ready.wait()
+        _, item = self._pending.popitem(last=False)
+        return item
+
+
+# One pattern subscription per process, messages are fanned out to the local subscribers
+# in memory, so that the Redis connections don't grow with the SSE clients.
+class _SseHub:
+    def __init__(self, pattern: str):
+        self.pattern = pattern
+        self.collapsed = 0
+        self.dropped = 0
+        self._subscribers: dict[str, set[_SseSubscriber]] = {}
+        self._task: Optional[asyncio.Task] = None
+
+    def start(self):
+        self._task = asyncio.create_task(self._run())
+
+    async def stop(self):
+        if self._task:
+            self._task.cancel()
+            await asyncio.gather(self._task, return_exceptions=True)
+            self._task = None
+
+    def subscribe(self, channel: str) -> _SseSubscriber:
+        subscriber = _SseSubscriber()
+        self._subscribers.setdefault(channel, set()).add(subscriber)
+        return subscriber
+
+    def unsubscribe(self, channel: str, subscriber: _SseSubscriber):
+        subscribers = self._subscribers.get(channel)
+        if subscribers is None:
+            return
+        subscribers.discard(subscriber)
+        if not subscribers:
+            del self._subscribers[channel]
+
+    def get_stats(self) -> dict:
+        return {
+            'pattern': self.pattern,
+            'channels': len(self._subscribers),
+            'subscribers': sum(len(s) for s in self._subscribers.values()),
+            'collapsed': self.collapsed,
+            'dropped': self.dropped,
+        }
+
+    async def _run(self):
+        while True:
+            pubsub = ards.pubsub()
+            try:
+                await pubsub.psubscribe(self.pattern)
+                logger.info(f'sse hub, psubscribe, pattern={self.pattern}')
+
+                while True:
+                    obj = await pubsub.get_message(
+                        ignore_subscribe_messages=True,
+                        timeout=_SSE_HUB_READ_TIMEOUT,
+                    )
+                    if isinstance(obj, dict):
+                        self._dispatch(obj['channel'].decode(), obj['data'])
+            except asyncio.CancelledError:
+                raise
+            except Exception:
+                # The messages published during reconnecting are lost,
+                # the clients will receive the next ones.
+                logger.exception(f'sse hub failed, reconnect, pattern={self.pattern}')  # nopep8.
+                await asyncio.sleep(_SSE_HUB_RECONNECT_INTERVAL)
+            finally:
+                await pubsub.close()
+
+    # Never blocks, a slow client only collapses its own pending messages,
+    # see _build_collapse_key; the oldest is dropped only if it's still full.
+    def _dispatch(self, channel: str, data: bytes):
+        subscribers = self._subscribers.get(channel)
+        if not subscribers:
+            return
+
+        # Render once for all subscribers.
+        message = SseMessage(**json.loads(data))
+        key = _build_collapse_key(message)
+        item = (message.event, str(message))
+
+        for subscriber in subscribers:
+            collapsed, dropped = subscriber.put(key, item)
+            self.collapsed += collapsed
+            if dropped:
+                self.dropped += 1
+                logger.warning(f'sse hub, subscriber too slow, drop oldest, channel={channel}')  # nopep8.
+
+
+_sse_hub: Optional[_SseHub] = None
+
+
+# Only the process serving SSE clients (the app) needs it,
+# sse_subscribe() falls back to a subscription per client for other channels.
+async def open_sse_hub(pattern: str):
+    global _sse_hub
+    if _sse_hub:
+        return
+
+    _sse_hub = _SseHub(pattern)
+    _sse_hub.start()
+
+
+async def close_sse_hub():
+    global _sse_hub
+    if not _sse_hub:
+        return
+
+    logger.info(f'close sse hub, stats={get_sse_hub_stats()}')
+    await _sse_hub.stop()
+    _sse_hub = None
+
+
+def get_sse_hub_stats() -> dict:
+    return _sse_hub.get_stats() if _sse_hub else {}
+
+
 async def sse_subscribe(channel: str):
+    if _sse_hub and fnmatchcase(channel, _sse_hub.pattern):
+        gen = _sse_subscribe_by_hub(_sse_hub, channel)
+    else:
+        gen = _sse_subscribe_by_pubsub(channel)
+
+    async for message in gen:
+        yield message
+
+
+async def _sse_subscribe_by_hub(hub: _SseHub, channel: str):
+    subscriber = hub.subscribe(channel)
+    logger.info(f'sse_subscribe, by hub, channel={channel}')
+
+    try:
+        while True:
+            async with async_timeout.timeout(_SSE_SUBSCRIBE_TIMEOUT):
+                event, message = await subscriber.get()
+            yield message
+
+            if event == SseEvent.CLOSE:
+                logger.info(f'sse_subscribe, on close, channel={channel}')
+                break  # while.
+    finally:
+        hub.unsubscribe(channel, subscriber)
+        logger.info(f'sse_unsubscribe, by hub, channel={channel}')
+
+
+# https://aioredis.readthedocs.io/en/latest/getting-started/#pubsub-mode
+async def _sse_subscribe_by_pubsub(channel: str):
     pubsub = ards.pubsub()
     await pubsub.subscribe(channel)
     logger.info(f'sse_subscribe, channel={channel}')
 
     try:
         while True:
-            async with async_timeout.timeout(300):  # 5 mins.
+            async with async_timeout.timeout(_SSE_SUBSCRIBE_TIMEOUT):
                 obj = await pubsub.get_message(ignore_subscribe_messages=True)
                 if isinstance(obj, dict):
                     message = SseMessage(**json.loads(obj['data']))
@@ -52,12 +257,13 @@ async def sse_subscribe(channel: str):
                         logger.info(f'sse_subscribe, on close, channel={channel}')  # nopep8.
                         break  # while.
     finally:
-        await sse_unsubscribe(channel)
+        await sse_unsubscribe(pubsub, channel)
 
 
-async def sse_unsubscribe(channel: str):
+async def sse_unsubscribe(pubsub, channel: str):
     try:
-        await ards.pubsub().unsubscribe(channel)
+        await pubsub.unsubscribe(channel)
+        await pubsub.close()
         logger.info(f'sse_unsubscribe, channel={channel}')
     except Exception:
         logger.exception(f'sse_unsubscribe, channel={channel}')
@@ -1,13 +1,23 @@
 import asyncio
 import json
+import time
 
-from dataclasses import asdict
+from dataclasses import asdict, dataclass, replace
+from enum import unique
 from sys import maxsize
+from typing import Awaitable, Callable, Sequence
 from uuid import uuid4
 
 from quart import abort
+from strenum import StrEnum
 from youtube_transcript_api import YouTubeTranscriptApi
 
+from checkpoint import ChapterCheckpoint, \
+    build_summary_checkpoint_digest, \
+    load_chapter_checkpoint, \
+    load_chapters_checkpoint, \
+    save_chapter_checkpoint, \
+    save_chapters_checkpoint
 from database.data import \
     Chapter, \
     ChapterSlicer, \
@@ -15,12 +25,16 @@ from database.data import \
     State, \
     TimedText
 from database.feedback import find_feedback
+from json_stream import JsonArrayStream
 from logger import logger
 from openai import Model, Role, \
     build_message, \
     chat, \
-    count_tokens, \
-    get_content
+    count_texts_tokens, \
+    count_tokens_async, \
+    get_content, \
+    reset_chat_schedule, \
+    set_chat_schedule
 from prompt import \
     GENERATE_MULTI_CHAPTERS_TOKEN_LIMIT_FOR_4K, \
     GENERATE_MULTI_CHAPTERS_TOKEN_LIMIT_FOR_16K, \
@@ -28,15 +42,106 @@ from prompt import \
     GENERATE_ONE_CHAPTER_TOKEN_LIMIT, \
     SUMMARIZE_FIRST_CHAPTER_SYSTEM_PROMPT, \
     SUMMARIZE_FIRST_CHAPTER_TOKEN_LIMIT, \
+    SUMMARIZE_MERGE_CHAPTER_SYSTEM_PROMPT, \
+    SUMMARIZE_MERGE_CHAPTER_TOKEN_LIMIT, \
     SUMMARIZE_NEXT_CHAPTER_SYSTEM_PROMPT, \
     SUMMARIZE_NEXT_CHAPTER_TOKEN_LIMIT, \
     generate_multi_chapters_example_messages_for_4k, \
     generate_multi_chapters_example_messages_for_16k
 from rds import rds
 from sse import SseEvent, sse_publish
-
+from token_budget import \
+    LinesPacker, \
+    build_indexed_json_packer, \
+    build_lines_packer, \
+    count_overhead_tokens
+from transcript import Transcript, normalize_timed_texts
+from transcript_cache import \
+    delete_no_transcript_cache, \
+    get_transcript_by_ref, \
+    get_transcript_cache, \
+    get_transcript_text_length, \
+    set_no_transcript_cache, \
+    set_transcript_cache
+
+# All summary channels, see open_sse_hub() in ./sse.py.
+SUMMARY_CHANNEL_PATTERN = 'summary_*'
+
+# The summarizing flag is reserved by the app until the job takes it over,
+# then it is a lease held by the job, see do_summarize_job in ./app.py.
 SUMMARIZING_RDS_KEY_EX = 300  # 5 mins.
-NO_TRANSCRIPT_RDS_KEY_EX = 8 * 60 * 60  # 8 hours.
+SUMMARIZING_RESERVED = 'reserved'
+SUMMARIZING_LEASE_EX = 60  # 1 min.
+SUMMARIZING_LEASE_INTERVAL = 20  # in seconds.
+SUMMARIZE_JOB_TIMEOUT = 300  # 5 mins, the default job_timeout of arq.
+SUMMARIZE_LONG_JOB_TIMEOUT = 20 * 60  # 20 mins, see LongWorkerSettings in ./app.py.
+# Jobs estimated more tokens than this go to the long queue,
+# i.e. the transcript can't be chaptered in 16k at once.
+SUMMARIZE_LONG_JOB_TOKENS = GENERATE_MULTI_CHAPTERS_TOKEN_LIMIT_FOR_16K
+# Rough but cheap, see estimate_summarize_tokens.
+_TOKENS_PER_CHARACTER = 0.3
+_TOKENS_PER_SECOND = 3.5
+# All chat() of the job must finish before the deadline, leave some time to save chapters.
+_SUMMARIZE_JOB_DEADLINE_MARGIN = 20  # in seconds.
+
+# Publish the partial chapter summary at most once per interval when streaming.
+SUMMARIZE_STREAM_INTERVAL = 0.5  # in seconds.
+
+# Keep the latest plans to tune the token limits in ./prompt.py.
+SUMMARY_PLANS_RDS_KEY = 'summary_plans'  # list of JSON string.
+SUMMARY_PLANS_MAX_LEN = 10000
+
+# Summarize the chapter by map-reduce if it has at least so many windows.
+SUMMARIZE_MAP_REDUCE_MIN_WINDOWS = 3
+
+# The completion ran to the end, instead of failing or being cut off midway.
+_FINISH_REASONS_COMPLETED = ('stop', 'length')
+
+
+# Short jobs shouldn't wait behind long ones, see WorkerSettings in ./app.py.
+@unique
+class SummarizeQueue(StrEnum):
+    SHORT = 'arq:queue:summarize_short'
+    LONG = 'arq:queue:summarize_long'
+
+
+@unique
+class TranscriptState(StrEnum):
+    FETCHING = 'fetching'
+    NO_TRANSCRIPT = 'no_transcript'
+
+
+@unique
+class ChapterSummaryStrategy(StrEnum):
+    AUTO = 'auto'
+    # Summarize windows one by one, each window refines the previous summary.
+    REFINE = 'refine'
+    # Summarize windows concurrently, then merge the summaries hierarchically.
+    MAP_REDUCE = 'map_reduce'
+
+
+@unique
+class SummaryConcurrency(StrEnum):
+    # Share the chat() concurrency of the worker with the other videos,
+    # and summarize the earlier chapters first.
+    SCHEDULED = 'scheduled'
+    # Summarize all chapters at once.
+    GATHER = 'gather'
+
+
+@unique
+class SummaryStrategy(StrEnum):
+    MULTI_CHAPTERS_4K = 'multi_chapters_4k'
+    MULTI_CHAPTERS_16K = 'multi_chapters_16k'
+    ONE_BY_ONE = 'one_by_one'
+
+
+@dataclass
+class SummaryPlan:
+    strategy: str = ''    # required; the cheapest viable strategy.
+    content: str = ''     # required; the transcript as JSON array.
+    tokens_4k: int = 0    # required; tokens of the 4k messages.
+    tokens_16k: int = 0   # required; tokens of the 16k messages.
 
 
 def build_summary_channel(vid: str) -> str:
@@ -51,16 +156,52 @@ def build_summary_response(state: State, chapters: list[Chapter] = []) -> dict:
     }
 
 
+def build_transcript_response(state: TranscriptState) -> dict:
+    return {
+        'state': state.value,
+    }
+
+
 def build_summarizing_rds_key(vid: str) -> str:
     return f'summarizing_{vid}'
 
 
-def build_no_transcript_rds_key(vid: str) -> str:
-    return f'no_transcript_{vid}'
+# The deadline of the job, derived from the job_timeout of the queue it runs on.
+def get_summarize_job_deadline(queue: str) -> float:
+    timeout = SUMMARIZE_LONG_JOB_TIMEOUT if queue == SummarizeQueue.LONG else SUMMARIZE_JOB_TIMEOUT  # nopep8.
+    return timeout - _SUMMARIZE_JOB_DEADLINE_MARGIN
+
+
+def build_summarize_job_id(vid: str, queue: SummarizeQueue) -> str:
+    return f'summarize_{vid}' if queue == SummarizeQueue.SHORT else f'summarize_{vid}_long'  # nopep8.
+
+
+# Estimate the tokens of the video without fetching the transcript,
+# by the cached transcript if any, otherwise by the last YouTube chapter;
+# returns 0 if unknown.
+def estimate_summarize_tokens(vid: str, chapters: list[dict]) -> int:
+    text_length = get_transcript_text_length(vid)
+    if text_length > 0:
+        return int(text_length * _TOKENS_PER_CHARACTER)
+
+    parsed = _parse_chapters(vid=vid, trigger='', chapters=chapters, lang='')
+    if parsed:
+        return int(max(c.start for c in parsed) * _TOKENS_PER_SECOND)
+
+    return 0
+
+
+def estimate_transcript_tokens(timed_texts: Transcript) -> int:
+    return int(timed_texts.text_length * _TOKENS_PER_CHARACTER)
+
+
+# Unknown goes to the short queue, the job will move itself to the long queue if needed.
+def choose_summarize_queue(tokens: int) -> SummarizeQueue:
+    return SummarizeQueue.LONG if tokens > SUMMARIZE_LONG_JOB_TOKENS else SummarizeQueue.SHORT  # nopep8.
 
 
 async def do_if_found_chapters_in_database(vid: str, chapters: list[Chapter]):
-    rds.delete(build_no_transcript_rds_key(vid))
+    delete_no_transcript_cache(vid)
     rds.delete(build_summarizing_rds_key(vid))
     channel = build_summary_channel(vid)
     data = build_summary_response(State.DONE, chapters)
@@ -68,11 +209,26 @@ async def do_if_found_chapters_in_database(vid: str, chapters: list[Chapter]):
     await sse_publish(channel=channel, event=SseEvent.CLOSE)
 
 
+async def do_if_no_transcript(vid: str):
+    set_no_transcript_cache(vid)
+    channel = build_summary_channel(vid)
+    data = build_transcript_response(TranscriptState.NO_TRANSCRIPT)
+    await sse_publish(channel=channel, event=SseEvent.TRANSCRIPT, data=data)
+    data = build_summary_response(State.NOTHING)
+    await sse_publish(channel=channel, event=SseEvent.SUMMARY, data=data)
+    await sse_publish(channel=channel, event=SseEvent.CLOSE)
+
+
 def need_to_resummarize(vid: str, chapters: list[Chapter] = []) -> bool:
     for c in chapters:
         if (not c.summary) or len(c.summary) <= 0:
             return True
 
+    return has_bad_feedback(vid)
+
+
+# Don't reuse the cached chat results if the summary is bad.
+def has_bad_feedback(vid: str) -> bool:
     feedback = find_feedback(vid)
     if not feedback:
         return False
@@ -89,8 +245,11 @@ def need_to_resummarize(vid: str, chapters: list[Chapter] = []) -> bool:
 
 
 # NoTranscriptFound, TranscriptsDisabled...
-def parse_timed_texts_and_lang(vid: str) -> tuple[list[TimedText], str]:
-    timed_texts: list[TimedText] = []
+def parse_timed_texts_and_lang(vid: str) -> tuple[Transcript, str]:
+    cached = get_transcript_cache(vid)
+    if cached and cached[0]:
+        logger.info(f'parse timed texts and lang, cached, vid={vid}')
+        return cached
 
     # https://en.wikipedia.org/wiki/Languages_used_on_the_Internet#Content_languages_on_YouTube
     codes = [
@@ -123,74 +282,146 @@ def parse_timed_texts_and_lang(vid: str) -> tuple[list[TimedText], str]:
 
     lang = transcript.language_code
     array: list[dict] = transcript.fetch()
+    array.sort(key=lambda d: d['start'])
 
-    for d in array:
-        timed_texts.append(TimedText(
-            start=d['start'],
-            duration=d['duration'],
+    timed_texts = Transcript.from_columns(
+        lang=lang,
+        starts=[d['start'] for d in array],
+        durations=[d['duration'] for d in array],
+        texts=[d['text'] for d in array],
+        is_generated=transcript.is_generated,
+    )
+
+    if timed_texts:
+        set_transcript_cache(
+            vid=vid,
+            timed_texts=timed_texts,
             lang=lang,
-            text=d['text'],
-        ))
+            is_generated=transcript.is_generated,
+        )
 
     return timed_texts, lang
 
 
+# YouTubeTranscriptApi is blocking, fetch in thread to not block the event loop
+# (and all SSE streams with it) during the YouTube round-trip.
+#
+# Load by the ref first if given, see get_transcript_ref() in ./transcript_cache.py.
+async def fetch_timed_texts_and_lang(vid: str, transcript_ref: str = '') -> tuple[Transcript, str]:
+    if transcript_ref:
+        found = await asyncio.to_thread(get_transcript_by_ref, transcript_ref)
+        if found and found[0]:
+            return found
+        logger.info(f'fetch timed texts and lang, but ref expired, vid={vid}, ref={transcript_ref}')  # nopep8.
+
+    await sse_publish(
+        channel=build_summary_channel(vid),
+        event=SseEvent.TRANSCRIPT,
+        data=build_transcript_response(TranscriptState.FETCHING),
+    )
+    return await asyncio.to_thread(parse_timed_texts_and_lang, vid)
+
+
+def _normalize_transcript(timed_texts: Sequence[TimedText], is_generated: bool, splits: list[float]) -> Transcript:  # nopep8.
+    return Transcript(normalize_timed_texts(
+        timed_texts=Transcript(timed_texts),
+        is_generated=is_generated,
+        splits=splits,
+    ))
+
+
 async def summarize(
     vid: str,
     trigger: str,
     chapters: list[dict],
-    timed_texts: list[TimedText],
+    timed_texts: Sequence[TimedText],
     lang: str,
     openai_api_key: str = '',
+    cache: bool = True,
+    stream: bool = False,
+    chapter_strategy: str = ChapterSummaryStrategy.AUTO.value,
+    concurrency: str = SummaryConcurrency.GATHER.value,
+    is_generated: bool = False,  # auto captions.
 ) -> tuple[list[Chapter], bool]:
     logger.info(
         f'summarize, '
         f'vid={vid}, '
         f'len(chapters)={len(chapters)}, '
         f'len(timed_texts)={len(timed_texts)}, '
-        f'lang={lang}')
+        f'lang={lang}, '
+        f'stream={stream}, '
+        f'chapter_strategy={chapter_strategy}, '
+        f'concurrency={concurrency}')
 
     has_exception = False
-    chapters: list[Chapter] = _parse_chapters(
+
+    # Resume the job interrupted before, e.g. the worker restarted.
+    digest = build_summary_checkpoint_digest(chapters, lang, len(timed_texts))
+    resumed = await load_chapters_checkpoint(vid, digest)
+    if resumed:
+        logger.info(f'summarize, resume from checkpoint, vid={vid}, len(chapters)={len(resumed)}')  # nopep8.
+
+    chapters: list[Chapter] = resumed or _parse_chapters(
         vid=vid,
         trigger=trigger,
         chapters=chapters,
         lang=lang,
     )
 
+    # Never merge across the chapter starts, see normalize_timed_texts.
+    splits = [c.start for c in chapters]
+    transcript = _normalize_transcript(timed_texts, is_generated, splits)
+
     if not chapters:
+        plan = await _plan(vid=vid, timed_texts=transcript, lang=lang)
+        strategy = SummaryStrategy.ONE_BY_ONE
+
         # Use the "outline" and "information" fields if they can be generated in 4k.
-        chapters = await _generate_multi_chapters(
-            vid=vid,
-            trigger=trigger,
-            timed_texts=timed_texts,
-            lang=lang,
-            model=Model.GPT_3_5_TURBO,
-            openai_api_key=openai_api_key,
-        )
-        if chapters:
-            await _do_before_return(vid, chapters)
-            return chapters, has_exception
+        if plan.strategy == SummaryStrategy.MULTI_CHAPTERS_4K:
+            strategy = SummaryStrategy.MULTI_CHAPTERS_4K
+            chapters = await _generate_multi_chapters(
+                vid=vid,
+                trigger=trigger,
+                content=plan.content,
+                lang=lang,
+                model=Model.GPT_3_5_TURBO,
+                openai_api_key=openai_api_key,
+                cache=cache,
+                stream=stream,
+            )
+            if chapters:
+                _record_plan(vid, plan, strategy, len(chapters))
+                await _do_before_return(vid, chapters)
+                return chapters, has_exception
 
         # Just use the "outline" field if it can be generated in 16k.
-        chapters = await _generate_multi_chapters(
-            vid=vid,
-            trigger=trigger,
-            timed_texts=timed_texts,
-            lang=lang,
-            model=Model.GPT_3_5_TURBO_16K,
-            openai_api_key=openai_api_key,
-        )
+        if plan.strategy != SummaryStrategy.ONE_BY_ONE and \
+                plan.tokens_16k < GENERATE_MULTI_CHAPTERS_TOKEN_LIMIT_FOR_16K:
+            strategy = SummaryStrategy.MULTI_CHAPTERS_16K
+            chapters = await _generate_multi_chapters(
+                vid=vid,
+                trigger=trigger,
+                content=plan.content,
+                lang=lang,
+                model=Model.GPT_3_5_TURBO_16K,
+                openai_api_key=openai_api_key,
+                cache=cache,
+                stream=stream,
+            )
 
         if not chapters:
+            strategy = SummaryStrategy.ONE_BY_ONE
             chapters = await _generate_chapters_one_by_one(
                 vid=vid,
                 trigger=trigger,
-                timed_texts=timed_texts,
+                timed_texts=transcript,
                 lang=lang,
                 openai_api_key=openai_api_key,
+                cache=cache,
             )
 
+        _record_plan(vid, plan, strategy, len(chapters))
+
         if not chapters:
             abort(500, f'summarize failed, no chapters, vid={vid}')
     else:
@@ -200,21 +431,29 @@ async def summarize(
             data=build_summary_response(State.DOING, chapters),
         )
 
+    if not resumed:
+        await save_chapters_checkpoint(vid, digest, chapters)
+
+    # The generated chapters are only known now.
+    if [c.start for c in chapters] != splits:
+        transcript = _normalize_transcript(timed_texts, is_generated, [c.start for c in chapters])  # nopep8.
+
     tasks = []
     for i, c in enumerate(chapters):
         start_time = c.start
         end_time = chapters[i + 1].start if i + 1 < len(chapters) else maxsize  # nopep8.
-        texts = _get_timed_texts_in_range(
-            timed_texts=timed_texts,
-            start_time=start_time,
-            end_time=end_time,
-        )
-        tasks.append(_summarize_chapter(
+        task = _summarize_chapter(
             chapter=c,
-            timed_texts=texts,
+            timed_texts=transcript.range(start_time, end_time),
             lang=lang,
             openai_api_key=openai_api_key,
-        ))
+            cache=cache,
+            stream=stream,
+            strategy=ChapterSummaryStrategy(chapter_strategy),
+        )
+        if concurrency == SummaryConcurrency.SCHEDULED:
+            task = _with_chat_schedule(vid, i, task)
+        tasks.append(task)
 
     res = await asyncio.gather(*tasks, return_exceptions=True)
     for r in res:
@@ -266,16 +505,9 @@ def _parse_chapters(
     return res
 
 
-# FIXME (Matthew Lee) suppurt stream.
-async def _generate_multi_chapters(
-    vid: str,
-    trigger: str,
-    timed_texts: list[TimedText],
-    lang: str,
-    model: Model = Model.GPT_3_5_TURBO,
-    openai_api_key: str = '',
-) -> list[Chapter]:
-    chapters: list[Chapter] = []
+# Serialize and tokenize the transcript only once,
+# then pick the cheapest viable strategy up front.
+async def _plan(vid: str, timed_texts: Transcript, lang: str) -> SummaryPlan:
     content: list[dict] = []
 
     for t in timed_texts:
@@ -287,28 +519,134 @@ async def _generate_multi_chapters(
             'text': text,
         })
 
-    user_message = build_message(
-        role=Role.USER,
-        content=json.dumps(content, ensure_ascii=False),
+    content = json.dumps(content, ensure_ascii=False)
+    empty_user_message = build_message(Role.USER, '')
+
+    # The tokens of the user message content plus the tokens of the other parts,
+    # see count_overhead_tokens() in ./token_budget.py.
+    tokens = (await count_texts_tokens([content]))[0]
+    tokens_4k = tokens + await count_tokens_async(
+        generate_multi_chapters_example_messages_for_4k(lang=lang) + [empty_user_message],  # nopep8.
+    )
+    tokens_16k = tokens + await count_tokens_async(
+        generate_multi_chapters_example_messages_for_16k(lang=lang) + [empty_user_message],  # nopep8.
+    )
+
+    if tokens_4k < GENERATE_MULTI_CHAPTERS_TOKEN_LIMIT_FOR_4K:
+        strategy = SummaryStrategy.MULTI_CHAPTERS_4K
+    elif tokens_16k < GENERATE_MULTI_CHAPTERS_TOKEN_LIMIT_FOR_16K:
+        strategy = SummaryStrategy.MULTI_CHAPTERS_16K
+    else:
+        strategy = SummaryStrategy.ONE_BY_ONE
+
+    logger.info(f'plan, '
+                f'vid={vid}, '
+                f'strategy={strategy}, '
+                f'tokens_4k={tokens_4k}, '
+                f'tokens_16k={tokens_16k}')
+
+    return SummaryPlan(
+        strategy=strategy.value,
+        content=content,
+        tokens_4k=tokens_4k,
+        tokens_16k=tokens_16k,
     )
 
+
+def _record_plan(vid: str, plan: SummaryPlan, strategy: SummaryStrategy, chapters: int):
+    record = asdict(plan)
+    del record['content']  # too large.
+    record['vid'] = vid
+    record['used'] = strategy.value  # may fallback from the planned one.
+    record['chapters'] = chapters
+    record['timestamp'] = int(time.time())
+
+    try:
+        rds.lpush(SUMMARY_PLANS_RDS_KEY, json.dumps(record))
+        rds.ltrim(SUMMARY_PLANS_RDS_KEY, 0, SUMMARY_PLANS_MAX_LEN - 1)
+    except Exception:
+        logger.exception(f'record plan failed, vid={vid}')
+
+
+# Publish every chapter as soon as its JSON object closes when streaming,
+# and keep the well-formed chapters even if the tail is malformed;
+# returns empty list if the chat failed or the stream was cut off midway,
+# so that the caller falls back to the next strategy.
+async def _generate_multi_chapters(
+    vid: str,
+    trigger: str,
+    content: str,
+    lang: str,
+    model: Model = Model.GPT_3_5_TURBO,
+    openai_api_key: str = '',
+    cache: bool = True,
+    stream: bool = False,
+) -> list[Chapter]:
+    chapters: list[Chapter] = []
+    user_message = build_message(role=Role.USER, content=content)
+
     if model == Model.GPT_3_5_TURBO:
         messages = generate_multi_chapters_example_messages_for_4k(lang=lang)
-        messages.append(user_message)
-        count = count_tokens(messages)
-        if count >= GENERATE_MULTI_CHAPTERS_TOKEN_LIMIT_FOR_4K:
-            logger.info(f'generate multi chapters with 4k, reach token limit, vid={vid}, count={count}')  # nopep8.
-            return chapters
     elif model == Model.GPT_3_5_TURBO_16K:
         messages = generate_multi_chapters_example_messages_for_16k(lang=lang)
-        messages.append(user_message)
-        count = count_tokens(messages)
-        if count >= GENERATE_MULTI_CHAPTERS_TOKEN_LIMIT_FOR_16K:
-            logger.info(f'generate multi chapters with 16k, reach token limit, vid={vid}, count={count}')  # nopep8.
-            return chapters
     else:
         abort(500, f'generate multi chapters with wrong model, model={model}')
 
+    messages.append(user_message)
+    parser = JsonArrayStream()
+    parsed = 0  # elements parsed into chapters.
+
+    def _parse(elements: list[dict]) -> list[Chapter]:
+        res: list[Chapter] = []
+        for r in elements:
+            chapter = r.get('outline', '')
+            information = r.get('information', '')
+            seconds = r.get('start', -1)
+            if not isinstance(chapter, str) or \
+                    not isinstance(information, str) or \
+                    not isinstance(seconds, (int, float)):
+                continue
+
+            chapter = chapter.strip()
+            information = information.strip()
+            if chapter and information and seconds >= 0:
+                res.append(Chapter(
+                    cid=str(uuid4()),
+                    vid=vid,
+                    trigger=trigger,
+                    slicer=ChapterSlicer.OPENAI.value,
+                    style=ChapterStyle.TEXT.value,
+                    start=int(seconds),
+                    lang=lang,
+                    chapter=chapter,
+                    summary=information,
+                ))
+        return res
+
+    # Returns True if any new chapter.
+    def _sync(content: str) -> bool:
+        nonlocal chapters, parsed
+        closed = parser.feed(content)
+
+        # The stream restarted, e.g. retried, rebuild the chapters from scratch.
+        if len(parser.elements) - len(closed) != parsed:
+            chapters = []
+
+        chapters.extend(_parse(closed))
+        parsed = len(parser.elements)
+        return bool(closed)
+
+    async def _on_content(content: str):
+        if not _sync(content):
+            return
+
+        # FIXME (Matthew Lee) prompt output may not sortd by seconds asc.
+        await sse_publish(
+            channel=build_summary_channel(vid),
+            event=SseEvent.SUMMARY,
+            data=build_summary_response(State.DOING, sorted(chapters, key=lambda c: c.start)),  # nopep8.
+        )
+
     try:
         body = await chat(
             messages=messages,
@@ -316,34 +654,25 @@ async def _generate_multi_chapters(
             top_p=0.1,
             timeout=90,
             api_key=openai_api_key,
+            stream=stream,
+            on_content=_on_content if stream else None,
+            cache=cache,
         )
 
         content = get_content(body)
-        logger.info(f'generate multi chapters, vid={vid}, content=\n{content}')
-
-        # FIXME (Matthew Lee) prompt output as JSON may not work (in the end).
-        res: list[dict] = json.loads(content)
+        finish_reason = body['choices'][0].get('finish_reason')
+        logger.info(f'generate multi chapters, vid={vid}, finish_reason={finish_reason}, content=\n{content}')  # nopep8.
     except Exception:
-        logger.exception(f'generate multi chapters failed, vid={vid}')
-        return chapters
+        logger.exception(f'generate multi chapters failed, vid={vid}, len(chapters)={len(chapters)}')  # nopep8.
+        return []
 
-    for r in res:
-        chapter = r.get('outline', '').strip()
-        information = r.get('information', '').strip()
-        seconds = r.get('start', -1)
+    if finish_reason not in _FINISH_REASONS_COMPLETED:
+        logger.warning(f'generate multi chapters, but not completed, vid={vid}, finish_reason={finish_reason}')  # nopep8.
+        return []
 
-        if chapter and information and seconds >= 0:
-            chapters.append(Chapter(
-                cid=str(uuid4()),
-                vid=vid,
-                trigger=trigger,
-                slicer=ChapterSlicer.OPENAI.value,
-                style=ChapterStyle.TEXT.value,
-                start=seconds,
-                lang=lang,
-                chapter=chapter,
-                summary=information,
-            ))
+    _sync(content)
+    if not parser.elements:
+        logger.warning(f'generate multi chapters, but no JSON array, vid={vid}')
 
     # FIXME (Matthew Lee) prompt output may not sortd by seconds asc.
     return sorted(chapters, key=lambda c: c.start)
@@ -352,17 +681,18 @@ async def _generate_multi_chapters(
 async def _generate_chapters_one_by_one(
     vid: str,
     trigger: str,
-    timed_texts: list[TimedText],
+    timed_texts: Transcript,
     lang: str,
     openai_api_key: str = '',
+    cache: bool = True,
 ) -> list[Chapter]:
     chapters: list[Chapter] = []
     timed_texts_start = 0
     latest_end_at = -1
+    packer = await build_indexed_json_packer(timed_texts)
 
     while True:
-        texts = timed_texts[timed_texts_start:]
-        if not texts:
+        if timed_texts_start >= len(timed_texts):
             logger.info(f'generate one chapter, drained, '
                         f'vid={vid}, '
                         f'len={len(timed_texts)}, '
@@ -370,34 +700,17 @@ async def _generate_chapters_one_by_one(
             break  # drained.
 
         system_prompt = GENERATE_ONE_CHAPTER_SYSTEM_PROMPT.format(
-            start_time=int(texts[0].start),
+            start_time=int(timed_texts[timed_texts_start].start),
             lang=lang,
         )
         system_message = build_message(Role.SYSTEM, system_prompt)
 
-        content: list[dict] = []
-        for t in texts:
-            text = t.text.strip()
-            if not text:
-                continue
-
-            temp = content.copy()
-            temp.append({
-                'index': timed_texts_start,
-                'start': int(t.start),
-                'text': text,
-            })
-
-            user_message = build_message(
-                role=Role.USER,
-                content=json.dumps(temp, ensure_ascii=False),
-            )
-
-            if count_tokens([system_message, user_message]) < GENERATE_ONE_CHAPTER_TOKEN_LIMIT:
-                content = temp
-                timed_texts_start += 1
-            else:
-                break  # for.
+        content: list[dict] = packer.pack(
+            start=timed_texts_start,
+            overhead=count_overhead_tokens(system_message),
+            token_limit=GENERATE_ONE_CHAPTER_TOKEN_LIMIT,
+        )
+        timed_texts_start += len(content)
 
         user_message = build_message(
             role=Role.USER,
@@ -416,6 +729,7 @@ async def _generate_chapters_one_by_one(
                 top_p=0.1,
                 timeout=90,
                 api_key=openai_api_key,
+                cache=cache,
             )
 
             content = get_content(body)
@@ -475,65 +789,111 @@ async def _generate_chapters_one_by_one(
     return chapters
 
 
-def _get_timed_texts_in_range(timed_texts: list[TimedText], start_time: int, end_time: int = maxsize) -> list[TimedText]:
-    res: list[TimedText] = []
-
-    for t in timed_texts:
-        if start_time <= t.start and t.start < end_time:
-            res.append(t)
-
-    return res
+# The priority is the index of the chapter, so the earlier (visible) chapters go first.
+async def _with_chat_schedule(key: str, priority: int, aw: Awaitable):
+    token = set_chat_schedule(key, priority)
+    try:
+        return await aw
+    finally:
+        reset_chat_schedule(token)
 
 
 async def _summarize_chapter(
     chapter: Chapter,
-    timed_texts: list[TimedText],
+    timed_texts: Transcript,
     lang: str,
     openai_api_key: str = '',
+    cache: bool = True,
+    stream: bool = False,
+    strategy: ChapterSummaryStrategy = ChapterSummaryStrategy.AUTO,
 ):
     vid = chapter.vid
-    summary = ''
-    summary_start = 0
-    refined_count = 0
+    checkpoint = await load_chapter_checkpoint(vid, chapter.cid) or ChapterCheckpoint()  # nopep8.
 
-    while True:
-        texts = timed_texts[summary_start:]
-        if not texts:
-            break  # drained.
+    if checkpoint.done:
+        logger.info(f'summarize chapter, resume from checkpoint, vid={vid}, cid={chapter.cid}')  # nopep8.
+        chapter.summary = checkpoint.summary
+        chapter.refined = checkpoint.refined
+        await sse_publish(
+            channel=build_summary_channel(vid),
+            event=SseEvent.SUMMARY,
+            data=build_summary_response(State.DOING, [chapter]),
+        )
+        return
+
+    packer = await build_lines_packer(timed_texts)
+    windows = _split_windows(chapter, packer, lang)
+
+    # Keep the strategy of the checkpoint, the progress is only valid for it.
+    if checkpoint.strategy:
+        strategy = ChapterSummaryStrategy(checkpoint.strategy)
+    elif strategy == ChapterSummaryStrategy.AUTO:
+        strategy = ChapterSummaryStrategy.MAP_REDUCE \
+            if len(windows) >= SUMMARIZE_MAP_REDUCE_MIN_WINDOWS \
+            else ChapterSummaryStrategy.REFINE
+    checkpoint.strategy = strategy.value
+
+    logger.info(f'summarize chapter, '
+                f'vid={vid}, '
+                f'cid={chapter.cid}, '
+                f'windows={len(windows)}, '
+                f'strategy={strategy}')
+
+    if strategy == ChapterSummaryStrategy.MAP_REDUCE:
+        summary, refined = await _summarize_chapter_by_map_reduce(
+            chapter=chapter,
+            packer=packer,
+            windows=windows,
+            lang=lang,
+            checkpoint=checkpoint,
+            openai_api_key=openai_api_key,
+            cache=cache,
+            stream=stream,
+        )
+    else:
+        summary, refined = await _summarize_chapter_by_refine(
+            chapter=chapter,
+            packer=packer,
+            lang=lang,
+            checkpoint=checkpoint,
+            openai_api_key=openai_api_key,
+            cache=cache,
+            stream=stream,
+        )
 
-        content = ''
-        content_has_changed = False
+    chapter.summary = summary.strip()
+    chapter.refined = refined
 
-        for t in texts:
-            lines = content + '\n' + f'[{t.text}]' if content else f'[{t.text}]'  # nopep8.
-            if refined_count <= 0:
-                system_prompt = SUMMARIZE_FIRST_CHAPTER_SYSTEM_PROMPT.format(
-                    chapter=chapter.chapter,
-                    lang=lang,
-                )
-            else:
-                system_prompt = SUMMARIZE_NEXT_CHAPTER_SYSTEM_PROMPT.format(
-                    chapter=chapter.chapter,
-                    summary=summary,
-                    lang=lang,
-                )
+    checkpoint.summary = chapter.summary
+    checkpoint.refined = chapter.refined
+    checkpoint.done = True
+    await save_chapter_checkpoint(vid, chapter.cid, checkpoint)
 
-            system_message = build_message(Role.SYSTEM, system_prompt)
-            user_message = build_message(Role.USER, lines)
-            token_limit = SUMMARIZE_FIRST_CHAPTER_TOKEN_LIMIT \
-                if refined_count <= 0 else SUMMARIZE_NEXT_CHAPTER_TOKEN_LIMIT
+    await sse_publish(
+        channel=build_summary_channel(vid),
+        event=SseEvent.SUMMARY,
+        data=build_summary_response(State.DOING, [chapter]),
+    )
 
-            if count_tokens([system_message, user_message]) < token_limit:
-                content_has_changed = True
-                content = lines.strip()
-                summary_start += 1
-            else:
-                break  # for.
 
-        # FIXME (Matthew Lee) it is possible that content not changed, simply avoid redundant requests.
-        if not content_has_changed:
-            logger.warning(f'summarize chapter, but content not changed, vid={vid}')  # nopep8.
-            break
+# Returns (summary, refined).
+async def _summarize_chapter_by_refine(
+    chapter: Chapter,
+    packer: LinesPacker,
+    lang: str,
+    checkpoint: ChapterCheckpoint,
+    openai_api_key: str = '',
+    cache: bool = True,
+    stream: bool = False,
+) -> tuple[str, int]:
+    vid = chapter.vid
+    summary = checkpoint.summary
+    summary_start = checkpoint.summary_start
+    refined_count = checkpoint.refined + 1 if summary_start > 0 else 0
+
+    while True:
+        if summary_start >= len(packer):
+            break  # drained.
 
         if refined_count <= 0:
             system_prompt = SUMMARIZE_FIRST_CHAPTER_SYSTEM_PROMPT.format(
@@ -548,6 +908,27 @@ async def _summarize_chapter(
             )
 
         system_message = build_message(Role.SYSTEM, system_prompt)
+        token_limit = SUMMARIZE_FIRST_CHAPTER_TOKEN_LIMIT \
+            if refined_count <= 0 else SUMMARIZE_NEXT_CHAPTER_TOKEN_LIMIT
+
+        summary_end = packer.pack(
+            start=summary_start,
+            overhead=count_overhead_tokens(system_message),
+            token_limit=token_limit,
+        )
+
+        # FIXME (Matthew Lee) it is possible that content not changed, simply avoid redundant requests.
+        if summary_end <= summary_start:
+            logger.warning(f'summarize chapter, but content not changed, vid={vid}')  # nopep8.
+            break
+
+        content = packer.join(summary_start, summary_end)
+        summary_start = summary_end
+
+        # Only stream the first summary, the refined summaries are not
+        # necessarily better than the existing one before they are finished.
+        stream_first = stream and refined_count <= 0
+
         user_message = build_message(Role.USER, content)
         body = await chat(
             messages=[system_message, user_message],
@@ -555,20 +936,189 @@ async def _summarize_chapter(
             top_p=0.1,
             timeout=90,
             api_key=openai_api_key,
+            cache=cache,
+            stream=stream_first,
+            on_content=_build_summary_streamer(chapter) if stream_first else None,
         )
 
         summary = get_content(body).strip()
         chapter.summary = summary  # cache even not finished.
         refined_count += 1
 
-    chapter.summary = summary.strip()
-    chapter.refined = refined_count - 1 if refined_count > 0 else 0
+        checkpoint.summary = summary
+        checkpoint.summary_start = summary_start
+        checkpoint.refined = refined_count - 1
+        await save_chapter_checkpoint(vid, chapter.cid, checkpoint)
 
-    await sse_publish(
-        channel=build_summary_channel(vid),
-        event=SseEvent.SUMMARY,
-        data=build_summary_response(State.DOING, [chapter]),
+    return summary, refined_count - 1 if refined_count > 0 else 0
+
+
+# Returns (summary, refined).
+async def _summarize_chapter_by_map_reduce(
+    chapter: Chapter,
+    packer: LinesPacker,
+    windows: list[tuple[int, int]],
+    lang: str,
+    checkpoint: ChapterCheckpoint,
+    openai_api_key: str = '',
+    cache: bool = True,
+    stream: bool = False,
+) -> tuple[str, int]:
+    system_prompt = SUMMARIZE_FIRST_CHAPTER_SYSTEM_PROMPT.format(
+        chapter=chapter.chapter,
+        lang=lang,
+    )
+    system_message = build_message(Role.SYSTEM, system_prompt)
+
+    # Only stream the final summary.
+    stream_last = stream and len(windows) == 1
+
+    async def _map(start: int, end: int) -> str:
+        window = f'{start}:{end}'
+        if window in checkpoint.windows:
+            return checkpoint.windows[window]
+
+        user_message = build_message(Role.USER, packer.join(start, end))
+        body = await chat(
+            messages=[system_message, user_message],
+            model=Model.GPT_3_5_TURBO,
+            top_p=0.1,
+            timeout=90,
+            api_key=openai_api_key,
+            cache=cache,
+            stream=stream_last,
+            on_content=_build_summary_streamer(chapter) if stream_last else None,
+        )
+
+        summary = get_content(body).strip()
+        checkpoint.windows[window] = summary
+        await save_chapter_checkpoint(chapter.vid, chapter.cid, checkpoint)
+        return summary
+
+    summaries = await asyncio.gather(*[_map(start, end) for start, end in windows])  # nopep8.
+    summary = await _merge_summaries(
+        chapter=chapter,
+        summaries=[s for s in summaries if s],
+        lang=lang,
+        openai_api_key=openai_api_key,
+        cache=cache,
+        stream=stream,
+    )
+
+    return summary, len(windows) - 1 if len(windows) > 0 else 0
+
+
+# Merge the summaries level by level, as many summaries per request as the token limit allows.
+async def _merge_summaries(
+    chapter: Chapter,
+    summaries: list[str],
+    lang: str,
+    openai_api_key: str = '',
+    cache: bool = True,
+    stream: bool = False,
+) -> str:
+    system_prompt = SUMMARIZE_MERGE_CHAPTER_SYSTEM_PROMPT.format(
+        chapter=chapter.chapter,
+        lang=lang,
+    )
+    system_message = build_message(Role.SYSTEM, system_prompt)
+    overhead = count_overhead_tokens(system_message)
+
+    async def _reduce(group: list[str], stream_last: bool) -> str:
+        # Nothing to merge with.
+        if len(group) <= 1:
+            return group[0]
+
+        user_message = build_message(Role.USER, '\n\n'.join(group))
+        body = await chat(
+            messages=[system_message, user_message],
+            model=Model.GPT_3_5_TURBO,
+            top_p=0.1,
+            timeout=90,
+            api_key=openai_api_key,
+            cache=cache,
+            stream=stream_last,
+            on_content=_build_summary_streamer(chapter) if stream_last else None,
+        )
+        return get_content(body).strip()
+
+    while len(summaries) > 1:
+        counts = await count_texts_tokens(summaries)
+        groups: list[list[str]] = []
+        group: list[str] = []
+        tokens = overhead
+
+        for summary, count in zip(summaries, counts):
+            # At least 2 summaries per request to make progress;
+            # 2 tokens more for the blank line separator.
+            if len(group) >= 2 and tokens + count + 2 >= SUMMARIZE_MERGE_CHAPTER_TOKEN_LIMIT:  # nopep8.
+                groups.append(group)
+                group = []
+                tokens = overhead
+            group.append(summary)
+            tokens += count + 2
+
+        if group:
+            groups.append(group)
+
+        stream_last = stream and len(groups) == 1
+        summaries = await asyncio.gather(*[_reduce(g, stream_last) for g in groups])  # nopep8.
+        summaries = [s for s in summaries if s]
+
+    return summaries[0] if summaries else ''
+
+
+# Split lines to windows by the first summary prompt, see _summarize_chapter_by_map_reduce.
+def _split_windows(chapter: Chapter, packer: LinesPacker, lang: str) -> list[tuple[int, int]]:
+    system_prompt = SUMMARIZE_FIRST_CHAPTER_SYSTEM_PROMPT.format(
+        chapter=chapter.chapter,
+        lang=lang,
     )
+    system_message = build_message(Role.SYSTEM, system_prompt)
+    overhead = count_overhead_tokens(system_message)
+
+    windows: list[tuple[int, int]] = []
+    start = 0
+
+    while start < len(packer):
+        end = packer.pack(
+            start=start,
+            overhead=overhead,
+            token_limit=SUMMARIZE_FIRST_CHAPTER_TOKEN_LIMIT,
+        )
+
+        # Can't fit even one line, same as _summarize_chapter_by_refine.
+        if end <= start:
+            logger.warning(f'split windows, but content not changed, vid={chapter.vid}')  # nopep8.
+            break
+
+        windows.append((start, end))
+        start = end
+
+    return windows
+
+
+def _build_summary_streamer(chapter: Chapter) -> Callable[[str], Awaitable[None]]:
+    channel = build_summary_channel(chapter.vid)
+    published_at = 0
+
+    async def on_content(content: str):
+        nonlocal published_at
+        now = time.monotonic()
+        if now - published_at < SUMMARIZE_STREAM_INTERVAL:
+            return
+
+        published_at = now
+
+        # Don't touch the chapter itself, the stream may be retried or failed.
+        partial = replace(chapter, summary=content.strip())
+        await sse_publish(
+            channel=channel,
+            event=SseEvent.SUMMARY,
+            data=build_summary_response(State.DOING, [partial]),
+        )
+
+    return on_content
 
 
 async def _do_before_return(vid: str, chapters: list[Chapter]):
@@ -0,0 +1,175 @@
+import json
+
+from bisect import bisect_left
+from itertools import accumulate
+from typing import Callable
+
+from database.data import TimedText
+from openai import Message, Role, \
+    build_message, \
+    count_text_tokens, \
+    count_texts_tokens, \
+    count_tokens
+from transcript import Transcript
+
+
+# Tokens of the messages without the user message content,
+# so that count_tokens([system_message, user_message]) always equals to
+# count_overhead_tokens(system_message) + count_text_tokens(user_message.content).
+def count_overhead_tokens(system_message: Message) -> int:
+    return count_tokens([system_message, build_message(Role.USER, '')])
+
+
+# Pack subtitles to lines like "[text...]\n[text...]", see summary._summarize_chapter.
+#
+# The cl100k_base regex always splits tokens after "]\n" and before "[",
+# so the tokens of the joined lines equals to the sum of the tokens of each line,
+# and we only need to encode each line once.
+class LinesPacker:
+    def __init__(
+        self,
+        timed_texts: Transcript,
+        last_tokens: list[int],
+        line_tokens: list[int],
+    ):
+        self._timed_texts = timed_texts
+        # The last line has no trailing "\n".
+        self._last_tokens = last_tokens
+        self._prefix_tokens = [0] + list(accumulate(line_tokens))
+
+    def __len__(self) -> int:
+        return len(self._timed_texts)
+
+    def count(self, start: int, end: int) -> int:
+        if end <= start:
+            return 0
+        return self._prefix_tokens[end - 1] - self._prefix_tokens[start] + self._last_tokens[end - 1]  # nopep8.
+
+    def join(self, start: int, end: int) -> str:
+        return '\n'.join(f'[{t.text}]' for t in self._timed_texts[start:end])
+
+    # Returns the end (exclusive) of lines start from `start` within token limit.
+    def pack(self, start: int, overhead: int, token_limit: int) -> int:
+        size = _bisect_size(
+            count=lambda size: overhead + self.count(start, start + size),
+            hi=max(len(self._timed_texts) - start, 0),
+            token_limit=token_limit,
+        )
+        return start + size
+
+
+# Pack subtitles to JSON array like '[{"index": 0, "start": 0, "text": "..."}]',
+# see summary._generate_chapters_one_by_one.
+#
+# The "index" field depends on where the packing starts,
+# but its digits are always split as standalone tokens by the cl100k_base regex,
+# so we encode each item with index 0 once, then fix the index tokens later.
+class IndexedJsonPacker:
+    def __init__(
+        self,
+        timed_texts: Transcript,
+        positions: list[int],
+        items: list[str],
+        last_tokens: list[int],
+        item_tokens: list[int],
+        index_tokens: list[int],
+    ):
+        self._timed_texts = timed_texts
+        self._positions = positions
+        self._items = items
+        self._zero_tokens = count_text_tokens('0')
+        self._last_tokens = [t - self._zero_tokens for t in last_tokens]
+        self._prefix_tokens = [0] + list(accumulate(t - self._zero_tokens for t in item_tokens))  # nopep8.
+        self._prefix_index_tokens = [0] + list(accumulate(index_tokens))
+
+    # Returns the packed items (as dict) start from `start` within token limit.
+    def pack(self, start: int, overhead: int, token_limit: int) -> list[dict]:
+        p = bisect_left(self._positions, start)
+        hi = len(self._positions) - p
+        if hi <= 0:
+            return []
+
+        # The first item is prefixed with "[" instead of " ".
+        zero = self._zero_tokens
+        first_item = self._items[p]
+        first_last_tokens = count_text_tokens(f'[{first_item}]') - zero
+        first_mid_tokens = count_text_tokens(f'[{first_item},') - zero
+
+        def count(size: int) -> int:
+            tokens = overhead
+            tokens += self._prefix_index_tokens[start + size] - self._prefix_index_tokens[start]  # nopep8.
+            if size == 1:
+                return tokens + first_last_tokens
+
+            tokens += first_mid_tokens
+            tokens += self._prefix_tokens[p + size - 1] - self._prefix_tokens[p + 1]  # nopep8.
+            tokens += self._last_tokens[p + size - 1]
+            return tokens
+
+        size = _bisect_size(count=count, hi=hi, token_limit=token_limit)
+        return [
+            {
+                'index': start + j,
+                'start': int(self._timed_texts[i].start),
+                'text': self._timed_texts[i].text.strip(),
+            }
+            for j, i in enumerate(self._positions[p:p + size])
+        ]
+
+
+async def build_lines_packer(timed_texts: Transcript) -> LinesPacker:
+    n = len(timed_texts)
+    counts = await count_texts_tokens(
+        [f'[{t.text}]' for t in timed_texts] +
+        [f'[{t.text}]\n' for t in timed_texts]
+    )
+    return LinesPacker(
+        timed_texts=timed_texts,
+        last_tokens=counts[:n],
+        line_tokens=counts[n:],
+    )
+
+
+async def build_indexed_json_packer(timed_texts: Transcript) -> IndexedJsonPacker:
+    # Empty texts are skipped, and don't take up any index.
+    positions = [i for i, t in enumerate(timed_texts) if t.text.strip()]
+    items = [_dumps_item(0, timed_texts[i]) for i in positions]
+
+    # Items are joined by ", ", the cl100k_base regex always splits tokens
+    # after "," and before " {", so each item takes its separator with it.
+    n = len(items)
+    counts = await count_texts_tokens(
+        [f' {item}]' for item in items] +
+        [f' {item},' for item in items] +
+        [str(i) for i in range(len(timed_texts) + 1)]
+    )
+
+    return IndexedJsonPacker(
+        timed_texts=timed_texts,
+        positions=positions,
+        items=items,
+        last_tokens=counts[:n],
+        item_tokens=counts[n:2 * n],
+        index_tokens=counts[2 * n:],
+    )
+
+
+def _dumps_item(index: int, timed_text: TimedText) -> str:
+    return json.dumps({
+        'index': index,
+        'start': int(timed_text.start),
+        'text': timed_text.text.strip(),
+    }, ensure_ascii=False)
+
+
+# Returns the max size in [0, hi] which count(size) < token_limit,
+# count(size) must be non-decreasing, and size 0 is always accepted.
+def _bisect_size(count: Callable[[int], int], hi: int, token_limit: int) -> int:
+    lo = 0
+    while lo < hi:
+        mid = (lo + hi + 1) // 2
+        if count(mid) < token_limit:
+            lo = mid
+        else:
+            hi = mid - 1
+    return lo
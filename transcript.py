@@ -0,0 +1,239 @@
+import re
+
+from array import array
+from bisect import bisect_left, bisect_right
+from itertools import accumulate
+from sys import maxsize
+from typing import Iterator, Sequence, Union
+
+from database.data import TimedText
+
+# Sound descriptions in captions, e.g. "[Music]", "[Applause]" and "♪".
+_NON_SPEECH_PATTERN = re.compile(r'\[[^\]]*\]|[♪♫]+')
+# The whole line is a sound description, e.g. "(laughter)".
+_NON_SPEECH_LINE_PATTERN = re.compile(r'^\([^)]*\)$')
+_SENTENCE_END_PATTERN = re.compile(r'[.!?。！？]["\'”’)]*$')
+# Languages written without spaces between words.
+_NO_SPACE_PATTERN = re.compile(r'[\u3000-\u303f\u3040-\u30ff\u3400-\u4dbf\u4e00-\u9fff\uff00-\uffef]')
+
+# Merge fragments into segments of about a sentence.
+_SEGMENT_MIN_LENGTH = 40  # in characters.
+_SEGMENT_MAX_LENGTH = 240  # in characters.
+_SEGMENT_MAX_DURATION = 30  # in seconds.
+# Never merge across a long silence.
+_SEGMENT_MAX_GAP = 5  # in seconds.
+# Overlap of rolling auto captions shorter than this is likely a real repetition of speech.
+_ROLLING_MIN_WORDS = 3
+
+
+# Columns of the timed texts, instead of an object (with __dict__) per line:
+# starts and durations in arrays of double, all texts in one string sliced by offsets,
+# and only one lang since all lines of a transcript are in the same language.
+class _Columns:
+    def __init__(self, lang: str, is_generated: bool, starts: array, durations: array, text: str, offsets: array):  # nopep8.
+        self.lang = lang
+        self.is_generated = is_generated  # auto captions.
+        self.starts = starts
+        self.durations = durations
+        self.text = text
+        self.offsets = offsets  # len(offsets) == len(starts) + 1
+
+
+# Timed texts sorted by start time, with the start times indexed for bisect.
+#
+# Slices and ranges are views of the same underlying columns without copying,
+# so that every chapter, packer and prompt can share one transcript;
+# TimedText is created on access only.
+class Transcript(Sequence[TimedText]):
+    def __init__(self, timed_texts: Sequence[TimedText] = ()):
+        if isinstance(timed_texts, Transcript):
+            self._columns = timed_texts._columns
+            self._lo = timed_texts._lo
+            self._hi = timed_texts._hi
+            return
+
+        # Stable, and almost free if already sorted.
+        ordered = sorted(timed_texts, key=lambda t: t.start)
+        self._columns = _build_columns(
+            lang=ordered[0].lang if ordered else '',
+            is_generated=False,
+            starts=[t.start for t in ordered],
+            durations=[t.duration for t in ordered],
+            texts=[t.text for t in ordered],
+        )
+        self._lo = 0
+        self._hi = len(ordered)
+
+    # Build from columns directly without creating any TimedText,
+    # the starts must be sorted.
+    @staticmethod
+    def from_columns(lang: str, starts: list[float], durations: list[float], texts: list[str], is_generated: bool = False) -> 'Transcript':  # nopep8.
+        columns = _build_columns(lang, is_generated, starts, durations, texts)
+        return Transcript._from(columns, 0, len(columns.starts))
+
+    @property
+    def lang(self) -> str:
+        return self._columns.lang
+
+    @property
+    def is_generated(self) -> bool:
+        return self._columns.is_generated
+
+    # Characters of all texts, to estimate the tokens cheaply.
+    @property
+    def text_length(self) -> int:
+        offsets = self._columns.offsets
+        return offsets[self._hi] - offsets[self._lo] if self._hi > self._lo else 0
+
+    def __len__(self) -> int:
+        return self._hi - self._lo
+
+    def __iter__(self) -> Iterator[TimedText]:
+        for i in range(self._lo, self._hi):
+            yield self._get(i)
+
+    def __getitem__(self, index: Union[int, slice]) -> Union[TimedText, 'Transcript']:  # nopep8.
+        if isinstance(index, slice):
+            lo, hi, step = index.indices(len(self))
+            if step != 1:
+                raise ValueError(f'transcript slice step must be 1, step={step}')
+            return Transcript._from(self._columns, self._lo + lo, self._lo + max(hi, lo))  # nopep8.
+
+        if index < 0:
+            index += len(self)
+        if index < 0 or index >= len(self):
+            raise IndexError(f'transcript index out of range, index={index}')
+        return self._get(self._lo + index)
+
+    # Returns the timed texts which start in [start_time, end_time).
+    def range(self, start_time: float, end_time: float = maxsize) -> 'Transcript':
+        starts = self._columns.starts
+        lo = bisect_left(starts, start_time, self._lo, self._hi)
+        hi = bisect_left(starts, end_time, lo, self._hi)
+        return Transcript._from(self._columns, lo, hi)
+
+    def _get(self, i: int) -> TimedText:
+        c = self._columns
+        return TimedText(
+            start=c.starts[i],
+            duration=c.durations[i],
+            lang=c.lang,
+            text=c.text[c.offsets[i]:c.offsets[i + 1]],
+        )
+
+    @staticmethod
+    def _from(columns: _Columns, lo: int, hi: int) -> 'Transcript':
+        view = Transcript.__new__(Transcript)
+        view._columns = columns
+        view._lo = lo
+        view._hi = hi
+        return view
+
+
+def _build_columns(lang: str, is_generated: bool, starts: list[float], durations: list[float], texts: list[str]) -> _Columns:  # nopep8.
+    return _Columns(
+        lang=lang,
+        is_generated=is_generated,
+        starts=array('d', starts),
+        durations=array('d', durations),
+        text=''.join(texts),
+        offsets=array('Q', accumulate((len(t) for t in texts), initial=0)),
+    )
+
+
+# Cut the prompt tokens of the timed texts without losing any speech:
+#
+#   * drop sound descriptions like "[Music]";
+#   * dedupe the repeated words of rolling auto captions, only if is_generated;
+#   * merge fragments into sentence-sized segments, keep the start time of the first one;
+#   * never merge across the splits, e.g. the chapter starts, so that the speech after
+#     a chapter start is never sliced into the previous chapter by Transcript.range().
+#
+# The timed texts must be sorted by start, e.g. Transcript.
+def normalize_timed_texts(timed_texts: Sequence[TimedText], is_generated: bool, splits: Sequence[float] = ()) -> list[TimedText]:  # nopep8.
+    splits = sorted(splits)
+    res: list[TimedText] = []
+    segment: list[TimedText] = []
+    previous = ''
+
+    def flush():
+        if not segment:
+            return
+        first, last = segment[0], segment[-1]
+        text = ''
+        for t in segment:
+            text = _join_text(text, t.text)
+        res.append(TimedText(
+            start=first.start,
+            duration=max(last.start + last.duration - first.start, 0),
+            lang=first.lang,
+            text=text,
+        ))
+        segment.clear()
+
+    for t in timed_texts:
+        text = _clean_text(t.text)
+        if is_generated:
+            text = _dedupe_rolling_text(previous, text)
+        if not text:
+            continue
+
+        if segment:
+            last = segment[-1]
+            i = bisect_right(splits, segment[0].start)  # the next split.
+            if t.start - (last.start + last.duration) > _SEGMENT_MAX_GAP or \
+                    t.start - segment[0].start > _SEGMENT_MAX_DURATION or \
+                    (i < len(splits) and splits[i] <= t.start):
+                flush()
+
+        previous = _clean_text(t.text)
+        segment.append(TimedText(
+            start=t.start,
+            duration=t.duration,
+            lang=t.lang,
+            text=text,
+        ))
+
+        length = sum(len(s.text) + 1 for s in segment)
+        if length >= _SEGMENT_MAX_LENGTH or \
+                (length >= _SEGMENT_MIN_LENGTH and _SENTENCE_END_PATTERN.search(text)):  # nopep8.
+            flush()
+
+    flush()
+    return res
+
+
+def _clean_text(text: str) -> str:
+    text = ' '.join(text.split())
+    if _NON_SPEECH_LINE_PATTERN.match(text):
+        return ''
+    text = _NON_SPEECH_PATTERN.sub(' ', text)
+    return ' '.join(text.split())
+
+
+# Returns the part of the text not repeated from the previous one,
+# compared by whole words, and only if at least _ROLLING_MIN_WORDS words are repeated.
+def _dedupe_rolling_text(previous: str, text: str) -> str:
+    previous_words = previous.split()
+    words = text.split()
+    if len(previous_words) < _ROLLING_MIN_WORDS or len(words) < _ROLLING_MIN_WORDS:  # nopep8.
+        return text
+
+    # The whole line is repeated from the end of the previous one.
+    if previous_words[-len(words):] == words:
+        return ''
+
+    # The end of the previous line rolls to the beginning of this one.
+    for n in range(min(len(previous_words), len(words)), _ROLLING_MIN_WORDS - 1, -1):  # nopep8.
+        if previous_words[-n:] == words[:n]:
+            return ' '.join(words[n:])
+
+    return text
+
+
+def _join_text(text: str, other: str) -> str:
+    if not text:
+        return other
+    if _NO_SPACE_PATTERN.match(text[-1]) and _NO_SPACE_PATTERN.match(other[0]):
+        return text + other
+    return f'{text} {other}'
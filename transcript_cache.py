@@ -0,0 +1,156 @@
+import hashlib
+import json
+import zstandard
+
+from typing import Optional, Sequence
+
+from database.data import TimedText
+from logger import logger
+from rds import rds
+from transcript import Transcript
+
+TRANSCRIPT_CACHE_EX = 7 * 24 * 60 * 60  # 7 days.
+NO_TRANSCRIPT_CACHE_EX = 8 * 60 * 60  # 8 hours.
+
+# Hash of every video, fields:
+#
+#   'selected': '{lang}:{kind}' of the transcript to use, or empty string if no transcript.
+#   'text_length': characters of the selected transcript.
+#   '{lang}:{kind}': ref of the transcript, kind is 'manual' or 'generated'.
+#
+# The ref is the digest of the transcript content, and the compressed transcript
+# is stored by its ref, so that the arq jobs only carry the ref instead of the transcript.
+_TRANSCRIPT_FIELD_SELECTED = 'selected'
+_TRANSCRIPT_FIELD_TEXT_LENGTH = 'text_length'
+_TRANSCRIPT_KIND_MANUAL = 'manual'
+_TRANSCRIPT_KIND_GENERATED = 'generated'
+
+# Subtitles are short and repetitive, level 3 is fast enough.
+_ZSTD_LEVEL = 3
+_zstd_compressor = zstandard.ZstdCompressor(level=_ZSTD_LEVEL)
+_zstd_decompressor = zstandard.ZstdDecompressor()
+
+
+def build_transcript_cache_rds_key(vid: str) -> str:
+    return f'transcript_refs_{vid}'
+
+
+def build_transcript_blob_rds_key(ref: str) -> str:
+    return f'transcript_blob_{ref}'
+
+
+def build_transcript_cache_field(lang: str, is_generated: bool) -> str:
+    kind = _TRANSCRIPT_KIND_GENERATED if is_generated else _TRANSCRIPT_KIND_MANUAL  # nopep8.
+    return f'{lang}:{kind}'
+
+
+# Returns the ref of the selected transcript, or empty string if not cached or no transcript.
+def get_transcript_ref(vid: str) -> str:
+    key = build_transcript_cache_rds_key(vid)
+    selected = rds.hget(key, _TRANSCRIPT_FIELD_SELECTED)
+    if not selected:
+        return ''
+
+    ref = rds.hget(key, selected)
+    return ref.decode() if ref else ''
+
+
+# Returns 0 if not cached or no transcript.
+def get_transcript_text_length(vid: str) -> int:
+    value = rds.hget(build_transcript_cache_rds_key(vid), _TRANSCRIPT_FIELD_TEXT_LENGTH)  # nopep8.
+    return int(value) if value else 0
+
+
+# Returns (timed_texts, lang) or None if not cached;
+# timed_texts is empty if the video has no transcript.
+def get_transcript_cache(vid: str) -> Optional[tuple[Transcript, str]]:
+    if has_no_transcript_cache(vid):
+        return Transcript(), ''
+
+    ref = get_transcript_ref(vid)
+    return get_transcript_by_ref(ref) if ref else None
+
+
+# Returns (timed_texts, lang) or None if expired.
+def get_transcript_by_ref(ref: str) -> Optional[tuple[Transcript, str]]:
+    value = rds.get(build_transcript_blob_rds_key(ref))
+    if not value:
+        return None
+
+    try:
+        return _decode(value)
+    except Exception:
+        logger.exception(f'get transcript by ref failed, ref={ref}')
+        return None
+
+
+# Returns the ref of the transcript.
+def set_transcript_cache(vid: str, timed_texts: Sequence[TimedText], lang: str, is_generated: bool) -> str:
+    key = build_transcript_cache_rds_key(vid)
+    field = build_transcript_cache_field(lang, is_generated)
+    ref, value = _encode(timed_texts, lang, is_generated)
+
+    pipe = rds.pipeline()
+    pipe.set(build_transcript_blob_rds_key(ref), value, ex=TRANSCRIPT_CACHE_EX)
+    pipe.hset(key, mapping={
+        _TRANSCRIPT_FIELD_SELECTED: field,
+        _TRANSCRIPT_FIELD_TEXT_LENGTH: sum(len(t.text) for t in timed_texts),
+        field: ref,
+    })
+    pipe.expire(key, TRANSCRIPT_CACHE_EX)
+    pipe.execute()
+
+    logger.info(f'set transcript cache, '
+                f'vid={vid}, '
+                f'field={field}, '
+                f'ref={ref}, '
+                f'len(timed_texts)={len(timed_texts)}, '
+                f'size={len(value)}')
+    return ref
+
+
+def set_no_transcript_cache(vid: str):
+    key = build_transcript_cache_rds_key(vid)
+    pipe = rds.pipeline()
+    pipe.delete(key)
+    pipe.hset(key, _TRANSCRIPT_FIELD_SELECTED, '')
+    pipe.expire(key, NO_TRANSCRIPT_CACHE_EX)
+    pipe.execute()
+
+
+def has_no_transcript_cache(vid: str) -> bool:
+    selected = rds.hget(build_transcript_cache_rds_key(vid), _TRANSCRIPT_FIELD_SELECTED)  # nopep8.
+    return selected is not None and not selected
+
+
+# Forget the no transcript entry only, keep the transcripts if cached.
+def delete_no_transcript_cache(vid: str):
+    if has_no_transcript_cache(vid):
+        rds.delete(build_transcript_cache_rds_key(vid))
+
+
+# Columnar JSON, the start and duration are in milliseconds,
+# then compressed by zstd; returns (ref, compressed).
+def _encode(timed_texts: Sequence[TimedText], lang: str, is_generated: bool) -> tuple[str, bytes]:  # nopep8.
+    value = json.dumps({
+        'lang': lang,
+        'generated': is_generated,
+        'start': [round(t.start * 1000) for t in timed_texts],
+        'duration': [round(t.duration * 1000) for t in timed_texts],
+        'text': [t.text for t in timed_texts],
+    }, ensure_ascii=False, separators=(',', ':')).encode()
+    return hashlib.sha256(value).hexdigest(), _zstd_compressor.compress(value)
+
+
+# Returns (timed_texts, lang).
+def _decode(value: bytes) -> tuple[Transcript, str]:
+    obj: dict = json.loads(_zstd_decompressor.decompress(value))
+    lang: str = obj['lang']
+    return Transcript.from_columns(
+        lang=lang,
+        starts=[start / 1000 for start in obj['start']],
+        durations=[duration / 1000 for duration in obj['duration']],
+        texts=obj['text'],
+        # Cached before the field existed, assume auto captions as before.
+        is_generated=obj.get('generated', True),
+    ), lang
@@ -1,21 +1,30 @@
+import asyncio
 import json
+import time
 
-from typing import Optional
+from typing import AsyncIterator, Awaitable, Callable, Optional
+from uuid import uuid4
 
 from langcodes import Language
 from quart import abort
 
-from database.chapter import find_chapter_by_cid
-from database.data import Translation
+from database.chapter import find_chapter_by_cid, find_chapters_by_vid
+from database.data import Chapter, Translation
 from database.translation import \
     find_translation, \
-    insert_or_update_translation
+    find_translations_by_vid, \
+    insert_or_update_translation, \
+    insert_or_update_translations
+from json_stream import JsonArrayStream
 from logger import logger
-from openai import Model, Role, \
+from openai import Message, Model, Role, TokenLimit, \
     build_message, \
     chat, \
-    count_tokens, \
+    count_texts_tokens, \
+    count_tokens_async, \
     get_content
+from rds import ards, KEY_TRANSLATION_PRECOMPUTE_TOKENS
+from single_flight import single_flight
 
 _TRANSLATION_SYSTEM_PROMPT = '''
 Given the following JSON object as shown below:
@@ -33,6 +42,45 @@ the translation should keep the same format as the original field.
 Do not output any redundant explanation other than JSON.
 '''
 
+_TRANSLATION_BATCH_SYSTEM_PROMPT = '''
+Given the following JSON array as shown below:
+
+```json
+[
+  {{
+    "index": 0,
+    "chapter": "text...",
+    "summary": "text..."
+  }}
+]
+```
+
+Translate the "chapter" field and "summary" field of every object to language {lang} in BCP 47,
+the translation should keep the same format as the original field,
+and keep the "index" field as is.
+
+Return a JSON array of the translated objects in the same order.
+Do not output any redundant explanation other than JSON.
+'''
+
+# Translate the chapters to the most requested languages in advance, see precompute_translations.
+TRANSLATION_PRECOMPUTE_LANGS = 3
+# Tokens per day, can be overridden by KEY_TRANSLATION_PRECOMPUTE_TOKENS in ./rds.py.
+_DEFAULT_TRANSLATION_PRECOMPUTE_TOKENS = 200000
+_TRANSLATION_PRECOMPUTE_TOKENS_EX = 2 * 24 * 60 * 60  # 2 days.
+
+# Sorted set, member is language code, score is the number of requests.
+_KEY_TRANSLATION_LANG_STATS = 'translation_lang_stats'
+# Sorted set, member is a random token of the user-facing translation,
+# score is the start timestamp; see has_translations_in_flight.
+_KEY_TRANSLATIONS_IN_FLIGHT = 'translations_in_flight'
+# Forget the translations that crashed without ending, longer than any normal one.
+_TRANSLATION_IN_FLIGHT_EX = 10 * 60  # 10 mins.
+
+# The output is about as long as the input, even longer for some languages,
+# so leave most of the context to the output.
+_TRANSLATION_BATCH_TOKEN_LIMIT = TokenLimit.GPT_3_5_TURBO * 3 / 8  # nopep8, 1536.
+
 
 async def translate(
     vid: str,
@@ -50,20 +98,292 @@ async def translate(
     if la.language == lb.language:
         return None
 
-    trans = find_translation(vid=vid, cid=cid, lang=lang)
-    if trans and trans.chapter and trans.summary:
+    await record_translation_lang(lang)
+
+    async def _load() -> Optional[Translation]:
+        trans = find_translation(vid=vid, cid=cid, lang=lang)
+        return trans if trans and trans.chapter and trans.summary else None
+
+    async def _fetch() -> Translation:
+        trans = await _translate_chapter(chapter, lang, openai_api_key)
+        insert_or_update_translation(trans)
         return trans
 
-    system_prompt = _TRANSLATION_SYSTEM_PROMPT.format(lang=lang)
+    # Many users may translate the same chapter of a popular video at the same time.
+    token = await _begin_translation()
+    try:
+        return await single_flight(
+            key=f'translation_{vid}_{cid}_{lang}',
+            load=_load,
+            fetch=_fetch,
+        )
+    finally:
+        await _end_translation(token)
+
+
+# Translate all chapters of the video, the returned iterator yields every translation
+# as soon as it's done; pack as many chapters as the token limit allows into one chat,
+# and save all translations in one transaction in the end.
+async def translate_all(
+    vid: str,
+    lang: str,
+    openai_api_key: str = '',
+) -> AsyncIterator[Translation]:
+    chapters = find_chapters_by_vid(vid)
+    if not chapters:
+        abort(404, f'translate all, but chapters not found, vid={vid}')
+
+    await record_translation_lang(lang)
+    translated, pending = _split_translated_chapters(vid, lang, chapters)
+
+    return _translate_all(
+        vid=vid,
+        lang=lang,
+        translated=translated,
+        pending=pending,
+        openai_api_key=openai_api_key,
+    )
+
+
+async def _translate_all(
+    vid: str,
+    lang: str,
+    translated: list[Translation],
+    pending: list[Chapter],
+    openai_api_key: str = '',
+) -> AsyncIterator[Translation]:
+    for trans in translated:
+        yield trans
+
+    if not pending:
+        return
+
+    system_prompt = _TRANSLATION_BATCH_SYSTEM_PROMPT.format(lang=lang)
     system_message = build_message(Role.SYSTEM, system_prompt)
-    user_message = build_message(Role.SYSTEM, json.dumps({
-        'chapter': chapter.chapter,
-        'summary': chapter.summary,
-    }, ensure_ascii=False))
+    batches = await _pack_chapters(system_message, pending)
+    logger.info(f'translate all, '
+                f'vid={vid}, '
+                f'lang={lang}, '
+                f'len(pending)={len(pending)}, '
+                f'len(batches)={len(batches)}')
+
+    queue: asyncio.Queue[Optional[Translation]] = asyncio.Queue()
+    done: list[Translation] = []
+
+    async def _translate_batches():
+        try:
+            await asyncio.gather(*[_translate_batch(
+                system_message=system_message,
+                batch=b,
+                lang=lang,
+                on_translation=queue.put,
+                openai_api_key=openai_api_key,
+            ) for b in batches])
+        finally:
+            await queue.put(None)
+
+    token = await _begin_translation()
+    task = asyncio.create_task(_translate_batches())
+
+    try:
+        while True:
+            trans = await queue.get()
+            if not trans:
+                break
+            done.append(trans)
+            yield trans
+    finally:
+        # The client may disconnect midway, save what's done anyway.
+        task.cancel()
+        while not queue.empty():
+            trans = queue.get_nowait()
+            if trans:
+                done.append(trans)
+        insert_or_update_translations(vid=vid, lang=lang, translations=done)
+        await _end_translation(token)
+
+
+async def _begin_translation() -> str:
+    token = str(uuid4())
+    await ards.zadd(_KEY_TRANSLATIONS_IN_FLIGHT, {token: time.time()})
+    return token
+
+
+async def _end_translation(token: str):
+    await ards.zrem(_KEY_TRANSLATIONS_IN_FLIGHT, token)
+
+
+# Returns True if any user is waiting for the translations, across all processes.
+async def has_translations_in_flight() -> bool:
+    now = time.time()
+    await ards.zremrangebyscore(_KEY_TRANSLATIONS_IN_FLIGHT, '-inf', now - _TRANSLATION_IN_FLIGHT_EX)  # nopep8.
+    return await ards.zcard(_KEY_TRANSLATIONS_IN_FLIGHT) > 0
+
+
+async def record_translation_lang(lang: str):
+    await ards.zincrby(_KEY_TRANSLATION_LANG_STATS, 1, lang)
+
+
+async def get_popular_translation_langs(limit: int = TRANSLATION_PRECOMPUTE_LANGS) -> list[str]:  # nopep8.
+    langs = await ards.zrevrange(_KEY_TRANSLATION_LANG_STATS, 0, limit - 1)
+    return [lang.decode() for lang in langs]
+
+
+# Translate the chapters of the video to the most requested languages in advance,
+# so that the first viewer in each language doesn't wait for the chat;
+# spend the tokens budget per day only, and stop as soon as should_yield() returns True.
+#
+# Returns False if yielded, or True if done (or out of budget).
+async def precompute_translations(
+    vid: str,
+    should_yield: Callable[[], Awaitable[bool]],
+    openai_api_key: str = '',
+) -> bool:
+    chapters = find_chapters_by_vid(vid)
+    if not chapters:
+        logger.info(f'precompute translations, but chapters not found, vid={vid}')  # nopep8.
+        return True
+
+    langs = await get_popular_translation_langs()
+    logger.info(f'precompute translations, vid={vid}, langs={langs}')
+
+    for lang in langs:
+        _, pending = _split_translated_chapters(vid, lang, chapters)
+        if not pending:
+            continue
+
+        system_prompt = _TRANSLATION_BATCH_SYSTEM_PROMPT.format(lang=lang)
+        system_message = build_message(Role.SYSTEM, system_prompt)
+
+        # One by one, low priority.
+        for batch in await _pack_chapters(system_message, pending):
+            if await should_yield():
+                logger.info(f'precompute translations, yield, vid={vid}, lang={lang}')  # nopep8.
+                return False
+
+            # The output is about as long as the input.
+            tokens = await _count_batch_tokens(system_message, batch) * 2
+            if not await _spend_precompute_tokens(tokens):
+                logger.info(f'precompute translations, out of budget, vid={vid}, lang={lang}')  # nopep8.
+                return True
+
+            translations: list[Translation] = []
+
+            async def _on_translation(trans: Translation):
+                translations.append(trans)
+
+            await _translate_batch(
+                system_message=system_message,
+                batch=batch,
+                lang=lang,
+                on_translation=_on_translation,
+                openai_api_key=openai_api_key,
+                spend_tokens=_spend_precompute_tokens,
+            )
+            insert_or_update_translations(vid=vid, lang=lang, translations=translations)  # nopep8.
+
+    return True
+
+
+# Returns False if the tokens exceed the budget of today.
+async def _spend_precompute_tokens(tokens: int) -> bool:
+    budget = await ards.get(KEY_TRANSLATION_PRECOMPUTE_TOKENS)
+    budget = int(budget) if budget else _DEFAULT_TRANSLATION_PRECOMPUTE_TOKENS
+
+    key = f'translation_precompute_tokens_{time.strftime("%Y%m%d", time.gmtime())}'  # nopep8.
+    spent = await ards.incrby(key, tokens)
+    await ards.expire(key, _TRANSLATION_PRECOMPUTE_TOKENS_EX)
+    if spent <= budget:
+        return True
+
+    await ards.decrby(key, tokens)
+    return False
+
+
+# Returns (translated, pending) of the chapters, except the chapters in the same language.
+def _split_translated_chapters(vid: str, lang: str, chapters: list[Chapter]) -> tuple[list[Translation], list[Chapter]]:  # nopep8.
+    la = Language.get(lang)
+    found = {t.cid: t for t in find_translations_by_vid(vid=vid, lang=lang)}
+    translated: list[Translation] = []
+    pending: list[Chapter] = []
+
+    for c in chapters:
+        # Avoid the same language.
+        if Language.get(c.lang).language == la.language:
+            continue
+
+        trans = found.get(c.cid)
+        if trans and trans.chapter and trans.summary:
+            translated.append(trans)
+        else:
+            pending.append(c)
+
+    return translated, pending
+
+
+async def _translate_batch(
+    system_message: Message,
+    batch: list[Chapter],
+    lang: str,
+    on_translation: Callable[[Translation], Awaitable[None]],
+    openai_api_key: str = '',
+    spend_tokens: Optional[Callable[[int], Awaitable[bool]]] = None,
+):
+    vid = batch[0].vid
+    parser = JsonArrayStream()
+    indexes: set[int] = set()  # translated.
+
+    async def _on_content(content: str):
+        for r in parser.feed(content):
+            index = r.get('index')
+            if type(index) is not int or index < 0 or index >= len(batch) or index in indexes:  # nopep8.
+                continue
+            trans = _build_translation(batch[index], lang, r)
+            if trans:
+                indexes.add(index)
+                await on_translation(trans)
+
+    user_message = build_message(Role.USER, _dumps_batch(batch))
+
+    try:
+        await chat(
+            messages=[system_message, user_message],
+            model=Model.GPT_3_5_TURBO,
+            top_p=0.1,
+            timeout=90,
+            api_key=openai_api_key,
+            stream=True,
+            on_content=_on_content,
+        )
+    except Exception:
+        logger.exception(f'translate batch failed, vid={vid}, lang={lang}, len(indexes)={len(indexes)}')  # nopep8.
+
+    # Translate the chapters missed in the output one by one,
+    # charge them too if spend_tokens is given, and stop if it returns False.
+    for i, c in enumerate(batch):
+        if i in indexes:
+            continue
+        if spend_tokens:
+            # The output is about as long as the input.
+            tokens = await count_tokens_async(_build_chapter_messages(c, lang)) * 2  # nopep8.
+            if not await spend_tokens(tokens):
+                logger.info(f'translate batch, chapter out of budget, vid={vid}, cid={c.cid}, lang={lang}')  # nopep8.
+                break
+        try:
+            trans = await _translate_chapter(c, lang, openai_api_key)
+        except Exception:
+            logger.exception(f'translate batch, chapter failed, vid={vid}, cid={c.cid}, lang={lang}')  # nopep8.
+            continue
+        await on_translation(trans)
+
+
+async def _translate_chapter(chapter: Chapter, lang: str, openai_api_key: str = '') -> Translation:
+    vid = chapter.vid
+    cid = chapter.cid
 
     # Don't check token limit here, let it go.
-    messages = [system_message, user_message]
-    tokens = count_tokens(messages)
+    messages = _build_chapter_messages(chapter, lang)
+    tokens = await count_tokens_async(messages)
     logger.info(f'translate, vid={vid}, cid={cid}, lang={lang}, tokens={tokens}')  # nopep8.
 
     body = await chat(
@@ -86,7 +406,7 @@ async def translate(
     if (not chapter) or (not summary):
         abort(500, f'translate, but chapter or summary empty, vid={vid}, cid={cid}, lang={lang}')  # nopep8.
 
-    trans = Translation(
+    return Translation(
         vid=vid,
         cid=cid,
         lang=lang,
@@ -94,5 +414,76 @@ async def translate(
         summary=summary,
     )
 
-    insert_or_update_translation(trans)
-    return trans
+
+def _build_chapter_messages(chapter: Chapter, lang: str) -> list[Message]:
+    system_prompt = _TRANSLATION_SYSTEM_PROMPT.format(lang=lang)
+    system_message = build_message(Role.SYSTEM, system_prompt)
+    user_message = build_message(Role.SYSTEM, json.dumps({
+        'chapter': chapter.chapter,
+        'summary': chapter.summary,
+    }, ensure_ascii=False))
+    return [system_message, user_message]
+
+
+# Returns batches of chapters in order, every batch within the token limit,
+# except for a single chapter exceeds the limit.
+#
+# Every item is counted with index 0 once, the small index is always one token anyway.
+async def _pack_chapters(system_message: Message, chapters: list[Chapter]) -> list[list[Chapter]]:  # nopep8.
+    overhead = await count_tokens_async([system_message, build_message(Role.USER, '[]')])  # nopep8.
+    counts = await count_texts_tokens([_dumps_item(0, c) for c in chapters])
+    batches: list[list[Chapter]] = []
+    batch: list[Chapter] = []
+    tokens = overhead
+
+    for c, count in zip(chapters, counts):
+        item_tokens = count + 1  # the separator.
+
+        if batch and tokens + item_tokens > _TRANSLATION_BATCH_TOKEN_LIMIT:
+            batches.append(batch)
+            batch = []
+            tokens = overhead
+
+        batch.append(c)
+        tokens += item_tokens
+
+    if batch:
+        batches.append(batch)
+    return batches
+
+
+async def _count_batch_tokens(system_message: Message, batch: list[Chapter]) -> int:
+    return await count_tokens_async([system_message, build_message(Role.USER, _dumps_batch(batch))])  # nopep8.
+
+
+def _dumps_batch(batch: list[Chapter]) -> str:
+    return '[' + ', '.join(_dumps_item(i, c) for i, c in enumerate(batch)) + ']'
+
+
+def _dumps_item(index: int, chapter: Chapter) -> str:
+    return json.dumps({
+        'index': index,
+        'chapter': chapter.chapter,
+        'summary': chapter.summary,
+    }, ensure_ascii=False)
+
+
+def _build_translation(chapter: Chapter, lang: str, res: dict) -> Optional[Translation]:
+    translated_chapter = res.get('chapter', '')
+    translated_summary = res.get('summary', '')
+    if not isinstance(translated_chapter, str) or not isinstance(translated_summary, str):  # nopep8.
+        return None
+
+    # Both fields must exist.
+    translated_chapter = translated_chapter.strip()
+    translated_summary = translated_summary.strip()
+    if (not translated_chapter) or (not translated_summary):
+        return None
+
+    return Translation(
+        vid=chapter.vid,
+        cid=chapter.cid,
+        lang=lang,
+        chapter=translated_chapter,
+        summary=translated_summary,
+    )